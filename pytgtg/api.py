@@ -1,18 +1,26 @@
 import re
 import random
+import sys
 import uuid
 import secrets
 import json
+import os
+import time
+from contextlib import contextmanager
+from types import MappingProxyType
+
+try:
+    import fcntl
+except ImportError:  # no shared configs on Windows
+    fcntl = None
 
 import httpx
-import socksio
-import ua_generator
-from google_play_scraper import app
 
 from exceptions import (
     TgtgConnectionError,
     TgtgForbiddenError,
     TgtgLoggedOutError,
+    TgtgOrderError,
     TgtgRequestError,
     TgtgUnauthorizedError,
     TgtgBadRequestError,
@@ -38,6 +46,7 @@ ORDER = "order/v8/"
 ACTIVE_ORDERS = ORDER + "active"
 # INACTIVE_ORDERS = ORDER + "inactive" # depreciated
 ABORT_ORDER = ORDER + "{}/abort"
+CREATE_ORDER = ORDER + "create/{}"
 
 INVITATION = "invitation/v1/order/{}/"
 ENABLE_INVITATION = INVITATION + "createOrEnable"
@@ -48,9 +57,54 @@ BUCKET = "discover/v1/bucket"
 DEVICE = "user/device/v1/"
 SET_USER_DEVICE = DEVICE + "setUserDevice"
 
+# the same for every account, configs only keep their own user agent and correlation id
+DEFAULT_HEADERS = MappingProxyType({
+    "content-type": "application/json; charset=utf-8",
+    "accept": "application/json",
+    "accept-language": "en-US",
+    "host": "api.toogoodtogo.com",
+    "accept-encoding": "gzip",
+    "x-24hourformat": "false",
+    "x-timezoneoffset": "+01:00"
+})
+
+
+direct_transport: httpx.HTTPTransport | None = None
+
+
+def directTransport() -> httpx.HTTPTransport:
+    # one connection pool and TLS context for every account that doesn't go through a proxy
+    global direct_transport
+    if direct_transport is None:
+        direct_transport = httpx.HTTPTransport(limits=httpx.Limits(max_connections=100, max_keepalive_connections=20))
+    return direct_transport
+
+
+def mergeConfig(base: dict, mine: dict, theirs: dict) -> None:
+    # three-way merge into mine, in place: what changed here since base wins, everything else comes from theirs
+    for key in mine.keys() | theirs.keys():
+        ours, disk, old = mine.get(key), theirs.get(key), base.get(key)
+        if isinstance(ours, dict) and isinstance(disk, dict):
+            mergeConfig(old if isinstance(old, dict) else {}, ours, disk)
+        elif (key in mine, ours) == (key in base, old):
+            if key in theirs:
+                mine[key] = disk
+            else:
+                mine.pop(key, None)
+
+
+def requestErrors() -> tuple[type[Exception], ...]:
+    socksio = sys.modules.get("socksio")  # only ever loaded by httpx for SOCKS proxies
+    if socksio:
+        return (socksio.exceptions.ProtocolError, httpx.HTTPError)
+    return (httpx.HTTPError,)
+
 
 class TooGoodToGoApi:
-    def __init__(self, config_fname: str = "config.json"):
+    __slots__ = ("config_fname", "config", "baseurl", "requests_count", "failed_requests", "proxy", "proxy_pool",
+                 "prepared_orders", "_client", "config_base", "config_mtime")
+
+    def __init__(self, config_fname: str = "config.json", proxy_pool=None):
         self.config_fname = config_fname
         self.config = self.loadConfig()
         self.setDefaultHeaders()
@@ -58,9 +112,19 @@ class TooGoodToGoApi:
         self.requests_count = 0
         self.failed_requests = 0
         self.proxy = ""
-        self.newClient()
+        self.proxy_pool = proxy_pool
+        self.prepared_orders: dict[tuple[str, int], tuple[tuple, httpx.Request]] = {}
+        self._client: httpx.Client | None = None
+
+    @property
+    def client(self) -> httpx.Client:
+        # created on first use, idle accounts don't hold a connection pool or a proxy slot
+        if self._client is None:
+            self.newClient(use_proxy=self.proxy_pool is not None)
+        return self._client # type: ignore
 
     def updateAppVersion(self) -> bool:
+        from google_play_scraper import app
         tgtg = app("com.app.tgtg")
         version = tgtg.get("version")
         if version:
@@ -73,24 +137,20 @@ class TooGoodToGoApi:
         return False
 
     def setDefaultHeaders(self) -> None:
-        headers = {
-            "content-type": "application/json; charset=utf-8",
-            "accept": "application/json",
-            "accept-language": "en-US",
-            "host": "api.toogoodtogo.com",
-            "accept-encoding": "gzip",
-            "x-24hourformat": "false",
-            "x-timezoneoffset": "+01:00"
-        }
-        for key, val in headers.items():
-            self.config["api"]["headers"][key] = val
-        self.saveConfig()
+        # drops the copies of DEFAULT_HEADERS older configs carry
+        headers = self.config["api"]["headers"]
+        shared = [key for key in headers if key in DEFAULT_HEADERS]
+        for key in shared:
+            del headers[key]
+        if shared:
+            self.saveConfig()
 
     def newCorrelationId(self) -> None:
         self.config["api"]["headers"]["x-correlation-id"] = str(uuid.uuid4())
         self.saveConfig()
 
     def randomizeUserAgent(self) -> bool:
+        import ua_generator
         user_agent = self.getUserAgent()
         new_agent = ua_generator.generate(platform='android').text
         pattern = r'(\([^)]+\))'
@@ -127,10 +187,19 @@ class TooGoodToGoApi:
         return f"{self.baseurl}{endpoint}"
 
     def newClient(self, use_proxy: bool = False) -> None:
-        self.client = httpx.Client(
-            cookies=httpx.Cookies(),
+        transport = directTransport()
+        self.proxy = ""
+        if use_proxy and self.proxy_pool:
+            proxy = self.proxy_pool.assign(self.config_fname)
+            if proxy:
+                # the proxy's transport, and its connection pool, is shared by every account on that proxy
+                transport, self.proxy = proxy.transport, proxy.url
+        cookies = self._client.cookies if self._client is not None else httpx.Cookies()
+        self._client = httpx.Client(
+            cookies=cookies,
             params=self.config.get("api").get("params"),
-            timeout=7.5 # default is 5s
+            timeout=7.5, # default is 5s
+            transport=transport
         )
 
     def getAuthHeaders(self, session: dict[str, str]) -> dict[str, str]:
@@ -142,12 +211,21 @@ class TooGoodToGoApi:
         self.requests_count += 1
         if track_failed:
             self.failed_requests += 1
+        start = time.monotonic()
         try:
             post = self.client.post(
                 self.url(endpoint), json=json, headers={**headers, **self.getHeaders()}
             )
-        except (socksio.exceptions.ProtocolError, httpx.HTTPError) as error:
+        except requestErrors() as error:
+            self.reportProxy(time.monotonic() - start, None)
             raise TgtgRequestError(endpoint, repr(error))
+        self.reportProxy(time.monotonic() - start, post.status_code)
+        self.checkResponse(endpoint, post)
+        if track_failed:
+            self.failed_requests = 0
+        return post
+
+    def checkResponse(self, endpoint: str, post: httpx.Response) -> None:
         if not post.is_success:
             message = f"Error {post.status_code} for post request {endpoint}"
             if post.status_code == 401:
@@ -159,9 +237,10 @@ class TooGoodToGoApi:
                 raise TgtgForbiddenError(endpoint, message, captcha, post)
             else:
                 raise TgtgConnectionError(endpoint, message, post)
-        if track_failed:
-            self.failed_requests = 0
-        return post
+
+    def reportProxy(self, latency: float, status: int | None) -> None:
+        if self.proxy and self.proxy_pool and not self.proxy_pool.report(self.proxy, latency, status):
+            self.newClient(use_proxy=True)
 
     def authByEmail(self) -> httpx.Response:
         self.newCorrelationId()
@@ -179,6 +258,7 @@ class TooGoodToGoApi:
             "accessToken": login["access_token"],
             "refreshToken": login["refresh_token"],
         }
+        self.setSessionExpiry(login.get("access_token_ttl_seconds"))
         self.saveConfig()
         return post.status_code
 
@@ -212,7 +292,18 @@ class TooGoodToGoApi:
         return self.config.get("api").get("session")
 
     def getHeaders(self) -> dict[str, str]:
-        return self.config.get("api").get("headers")
+        return {**DEFAULT_HEADERS, **self.config.get("api").get("headers")}
+
+    def setSessionExpiry(self, ttl_seconds: int | None) -> None:
+        if ttl_seconds:
+            self.config["api"]["session"]["accessTokenExpiry"] = time.time() + ttl_seconds
+        else:
+            self.config["api"]["session"].pop("accessTokenExpiry", None)
+
+    def isSessionValid(self, margin: float = 60) -> bool:
+        session = self.getSession()
+        expiry = session.get("accessTokenExpiry")
+        return bool(session.get("accessToken")) and expiry is not None and expiry - margin > time.time()
 
     def getCredentials(self) -> dict[str, str]:
         return self.config.get("api").get("credentials")
@@ -220,14 +311,28 @@ class TooGoodToGoApi:
     def setCookie(self, key:str, value: str) -> None:
         self.client.cookies.set(key, value, COOKIE_DOMAIN)
 
+    def getCookies(self) -> list[dict[str, str | None]]:
+        if self._client is None:
+            return []
+        return [{"name": cookie.name, "value": cookie.value, "domain": cookie.domain, "path": cookie.path}
+                for cookie in self._client.cookies.jar]
+
+    def setCookies(self, cookies: list[dict]) -> None:
+        for cookie in cookies:
+            self.client.cookies.set(cookie["name"], cookie["value"], cookie["domain"], cookie["path"])
+
     def refreshToken(self) -> httpx.Response:
-        session = self.getSession()
-        json = {"refresh_token": session.get("refreshToken")}
-        res = self.post(REFRESH, json=json, track_failed=False)
-        self.config["api"]["session"]["refreshToken"] = res.json().get("refresh_token")
-        self.config["api"]["session"]["accessToken"] = res.json().get("access_token")
-        self.config["origin"] = self.randomizeLocation(self.config.get("origin"))
-        self.saveConfig()
+        # the config's lock is never held over the request: read the token with it, then merge and write the new ones
+        with self.lockedConfig():  # another node may have rotated the refresh token already
+            refresh_token = self.getSession().get("refreshToken")
+        res = self.post(REFRESH, json={"refresh_token": refresh_token}, track_failed=False)
+        with self.lockedConfig():
+            if self.getSession().get("refreshToken") == refresh_token:  # otherwise another node refreshed meanwhile, keep its tokens
+                self.config["api"]["session"]["refreshToken"] = res.json().get("refresh_token")
+                self.config["api"]["session"]["accessToken"] = res.json().get("access_token")
+                self.setSessionExpiry(res.json().get("access_token_ttl_seconds"))
+            self.config["origin"] = self.randomizeLocation(self.config.get("origin"))
+            self.writeConfig()
         self.requests_count = 0
         return res
 
@@ -253,11 +358,12 @@ class TooGoodToGoApi:
         return self.post(SET_USER_DEVICE, json=json, headers=headers)
 
     def listBucket(
-        self, type: str = "Favorites", radius: int = 200, page: int = 0, page_size: int = 50
+        self, type: str = "Favorites", radius: float = 200, page: int = 0, page_size: int = 50,
+        origin: dict[str, float] | None = None
     ) -> httpx.Response:
         session = self.getSession()
         json = {
-            "origin": self.config.get("origin"),
+            "origin": origin or self.config.get("origin"),
             "radius": radius,
             "paging": {"page": page, "size": page_size},
             "bucket": {"filler_type": type},
@@ -285,6 +391,16 @@ class TooGoodToGoApi:
         headers = self.getAuthHeaders(session)
         return self.post(ORDER, json=json, headers=headers)
 
+    def iterOrders(self, page_size: int = 20):
+        page = 0
+        while True:
+            months = self.getOrders(page=page, page_size=page_size).json().get("orders_per_month") or []
+            orders = [order for month in months for order in month.get("orders", [])]
+            yield from orders
+            if len(orders) < page_size:
+                return
+            page += 1
+
     def setFavorite(
         self, item_id: str | int, is_favorite: bool = True
     ) -> httpx.Response:
@@ -299,6 +415,45 @@ class TooGoodToGoApi:
         json = {"origin": None}
         return self.post(ITEM_INFO.format(item_id), json=json, headers=headers)
 
+    def prepareOrder(self, item_id: str, item_count: int) -> httpx.Request:
+        # built ahead of time, only rebuilt when the tokens, headers or cookies it carries have changed
+        key = (self.getSession().get("accessToken"), self.getUserAgent(), tuple(self.client.cookies.items()))
+        prepared = self.prepared_orders.get((item_id, item_count))
+        if prepared and prepared[0] == key:
+            return prepared[1]
+        headers = {**self.getAuthHeaders(self.getSession()), **self.getHeaders()}
+        request = self.client.build_request("POST", self.url(CREATE_ORDER.format(item_id)),
+                                            json={"item_count": item_count}, headers=headers)
+        self.prepared_orders[(item_id, item_count)] = (key, request)
+        return request
+
+    def createOrder(self, item_id: str, item_count: int) -> dict:
+        endpoint = CREATE_ORDER.format(item_id)
+        request = self.prepareOrder(item_id, item_count)
+        self.requests_count += 1
+        start = time.monotonic()
+        try:
+            post = self.client.send(request)
+        except requestErrors() as error:
+            self.reportProxy(time.monotonic() - start, None)
+            raise TgtgRequestError(endpoint, repr(error))
+        self.reportProxy(time.monotonic() - start, post.status_code)
+        if 400 <= post.status_code < 500 and post.status_code not in (401, 403, 429):
+            # refused (sold out, over the limit...), not a connection problem
+            try:
+                errors = post.json().get("errors") or [{}]
+                reason = errors[0].get("code") or errors[0].get("message")
+            except (ValueError, AttributeError, IndexError):
+                reason = None
+            raise TgtgOrderError(endpoint, f"Error {post.status_code} ordering {item_count} of item {item_id}", item_id,
+                                 str(reason or f"HTTP {post.status_code}"), post)
+        self.checkResponse(endpoint, post)
+        res = post.json()
+        state = res.get("state")
+        if state != "SUCCESS":
+            raise TgtgOrderError(endpoint, f"Failed to order {item_count} of item {item_id}: {state}", item_id, str(state), post)
+        return res.get("order", {})
+
     def abortOrder(self, order_id: str) -> httpx.Response:
         session = self.getSession()
         headers = self.getAuthHeaders(session)
@@ -316,13 +471,49 @@ class TooGoodToGoApi:
         headers = self.getAuthHeaders(session)
         return self.post(DISABLE_INVITATION.format(invitation_id), headers=headers)
 
+    def getConfigMtime(self) -> tuple[int, int]:
+        try:
+            stat = os.stat(self.config_fname)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return 0, 0
+
+    def isConfigStale(self) -> bool:
+        # written by another process since we last loaded or saved it
+        return self.getConfigMtime() != self.config_mtime
+
+    @contextmanager
+    def lockedConfig(self):
+        # other nodes share this config: hold its lock file and merge what they wrote before changing it
+        with open(f"{self.config_fname}.lock", "a") as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.isConfigStale():
+                self.syncConfig()
+            yield
+
+    def syncConfig(self) -> None:
+        base = json.loads(self.config_base)
+        theirs = self.loadConfig()
+        mergeConfig(base, self.config, theirs)
+
+    def writeConfig(self) -> None:
+        text = json.dumps(self.config, indent=4)
+        with open(f"{self.config_fname}.tmp", "w") as outfile:
+            outfile.write(text)
+        os.replace(f"{self.config_fname}.tmp", self.config_fname)  # readers never see a half written config
+        self.config_base = text
+        self.config_mtime = self.getConfigMtime()
+
     def saveConfig(self) -> None:
-        with open(self.config_fname, "w") as outfile:
-            json.dump(self.config, outfile, indent=4)
+        with self.lockedConfig():
+            self.writeConfig()
 
-    def loadConfig(self):
+    def loadConfig(self) -> dict:
         with open(self.config_fname, "r") as infile:
-            return json.load(infile)
+            self.config_base = infile.read()
+        self.config_mtime = self.getConfigMtime()
+        return json.loads(self.config_base)
 
 
 if __name__ == "__main__":
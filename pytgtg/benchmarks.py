@@ -0,0 +1,216 @@
+import argparse
+import datetime
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+
+# socksio isn't listed, httpcore imports it on its own whenever it is installed
+LAZY_MODULES = ("google_play_scraper", "ua_generator", "aiosmtplib", "dateutil", "email.mime.multipart")
+
+# each snippet runs in a fresh interpreter and prints a json dict of timings
+CLI_STARTUP = """
+import json, sys, time
+start = time.perf_counter()
+import watcher
+imported = time.perf_counter()
+w = watcher.TooGoodToGoWatcher("config.json")
+w.api.baseurl = sys.argv[1]
+w.api.listFavoriteBusinesses()
+polled = time.perf_counter()
+print(json.dumps({"import": imported - start, "first_poll": polled - start,
+                  "loaded": [m for m in sys.argv[2:] if m in sys.modules]}))
+"""
+
+BOT_STARTUP = """
+import json, sys, time
+start = time.perf_counter()
+import telegrambot
+imported = time.perf_counter()
+bot = telegrambot.TooGoodToGoTelegram("123456:benchmark")
+ready = time.perf_counter()
+user = next(iter(bot.users.values()))
+user.api.baseurl = sys.argv[1]
+user.getMatches({"*": {"qty": 1}})
+polled = time.perf_counter()
+print(json.dumps({"import": imported - start, "ready": ready - start, "first_poll": polled - start,
+                  "loaded": [m for m in sys.argv[2:] if m in sys.modules]}))
+"""
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # answers every TGTG endpoint with a well-formed payload
+    favourite_items: list[dict] = []
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers.get("content-length", 0)))
+        body = json.dumps({"favourite_items": self.favourite_items, "orders_per_month": [], "mobile_bucket": {"items": []},
+                           "state": "SUCCESS", "order": {"id": "benchmark"}}).encode()
+        self.send_response(200)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+def startStandInServer() -> tuple[ThreadingHTTPServer, str]:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/api/"
+
+
+def prepareWorkdir(users: int) -> str:
+    workdir = tempfile.mkdtemp(prefix="tgtg-bench-")
+    shutil.copy(f"{PATH}/config.json.defaults", f"{workdir}/config.json")
+    for chat_id in range(1, users + 1):
+        shutil.copy(f"{PATH}/config.json.defaults", f"{workdir}/config_{chat_id}.json")
+    return workdir
+
+
+def runSnippet(snippet: str, workdir: str, baseurl: str) -> dict:
+    env = {**os.environ, "PYTHONPATH": PATH, "LOG_LEVEL": "ERROR"}
+    out = subprocess.run([sys.executable, "-c", snippet, baseurl, *LAZY_MODULES],
+                         cwd=workdir, env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def summarize(runs: list[dict]) -> dict:
+    keys = [k for k in runs[0] if k != "loaded"]
+    res: dict = {k: round(statistics.median(run[k] for run in runs) * 1000, 2) for k in keys}
+    res["eagerly_loaded"] = sorted({m for run in runs for m in run["loaded"]})
+    return res
+
+
+def benchStartup(repeat: int, users: int) -> dict:
+    server, baseurl = startStandInServer()
+    workdir = prepareWorkdir(users)
+    try:
+        cli = [runSnippet(CLI_STARTUP, workdir, baseurl) for _ in range(repeat)]
+        bot = [runSnippet(BOT_STARTUP, workdir, baseurl) for _ in range(repeat)]
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {"benchmark": "startup", "unit": "ms", "repeat": repeat, "users": users,
+            "cli": summarize(cli), "bot": summarize(bot)}
+
+
+def benchReserve(repeat: int) -> dict:
+    # detection to reservation: prepared request on the polling connection vs a cold client building the request
+    sys.path.insert(0, PATH)
+    import api
+    import httpx
+    server, baseurl = startStandInServer()
+    workdir = prepareWorkdir(0)
+    try:
+        tgtg = api.TooGoodToGoApi(f"{workdir}/config.json")
+        tgtg.baseurl = baseurl
+        warm, cold = [], []
+        for _ in range(repeat):
+            tgtg.listFavoriteBusinesses()
+            tgtg.prepareOrder("1", 1)
+            start = time.perf_counter()
+            tgtg.createOrder("1", 1)
+            warm.append(time.perf_counter() - start)
+
+            # a client of its own: newClient() would reuse the shared transport and its open connections
+            warm_client = tgtg.client
+            tgtg._client = httpx.Client(cookies=warm_client.cookies, params=tgtg.config.get("api").get("params"),
+                                        timeout=7.5, transport=httpx.HTTPTransport())
+            tgtg.prepared_orders = {}
+            start = time.perf_counter()
+            tgtg.createOrder("1", 1)
+            cold.append(time.perf_counter() - start)
+            tgtg.client.close()
+            tgtg._client = warm_client
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {"benchmark": "reserve", "unit": "ms", "repeat": repeat,
+            "prepared_warm": round(statistics.median(warm) * 1000, 3), "cold": round(statistics.median(cold) * 1000, 3)}
+
+
+def standInItem(item_id: int, available: int) -> dict:
+    return {"item": {"item_id": str(item_id), "item_price": {"code": "EUR", "minor_units": 399, "decimals": 2}},
+            "store": {"store_id": str(item_id // 2), "store_name": f"Store {item_id // 2}"},
+            "display_name": f"Store {item_id // 2} - Magic Bag", "items_available": available,
+            "purchase_end": "2030-01-01T20:00:00Z",
+            "pickup_interval": {"start": "2030-01-01T19:00:00Z", "end": "2030-01-01T20:00:00Z"}}
+
+
+def benchMemory(users: int, targets: int) -> dict:
+    # bytes allocated per user object: idle (loaded from its config) and watching (client, one poll's state)
+    import gc
+    import tracemalloc
+    sys.path.insert(0, PATH)
+    StandInHandler.favourite_items = [standInItem(item_id, item_id % 3) for item_id in range(targets)]
+    server, baseurl = startStandInServer()
+    workdir = prepareWorkdir(users)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        import events
+        import telegrambot
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        loaded = [telegrambot.User(chat_id) for chat_id in range(1, users + 1)]
+        gc.collect()
+        idle = tracemalloc.get_traced_memory()[0]
+        for user in loaded:
+            user.targets.update({str(item_id): {"qty": 1, "display_name": ""} for item_id in range(targets)})
+            user.compileRules()
+            user.api.baseurl = baseurl
+            matches = user.getMatches(user.targets, minQty=0)
+            events.diffItems(user.chat_id, user.seen, matches)
+            del matches
+        gc.collect()
+        watching = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {"benchmark": "memory", "unit": "bytes", "users": users, "targets": targets,
+            "idle_per_user": (idle - before) // users, "watching_per_user": (watching - before) // users}
+
+
+def record(result: dict, fname: str | None) -> None:
+    result["date"] = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+    line = json.dumps(result)
+    print(line)
+    if fname:
+        with open(fname, "a") as outfile:
+            outfile.write(line + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="py-tgtg benchmarks")
+    parser.add_argument("--record", help="Append the results to this JSON lines file to track them over time")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    startup = subparsers.add_parser("startup", help="Cold start: import time and time to the first poll, CLI and bot")
+    startup.add_argument("--repeat", type=int, default=5, help="Number of cold starts to take the median of (default: 5)")
+    startup.add_argument("--users", type=int, default=10, help="Number of user configs the bot loads (default: 10)")
+    reserve = subparsers.add_parser("reserve", help="Latency of an order creation, prepared and warm vs cold")
+    reserve.add_argument("--repeat", type=int, default=50, help="Number of reservations to take the median of (default: 50)")
+    memory = subparsers.add_parser("memory", help="Bytes per idle and per watching user")
+    memory.add_argument("--users", type=int, default=500, help="Number of users to create (default: 500)")
+    memory.add_argument("--targets", type=int, default=10, help="Number of targets per watching user (default: 10)")
+    args = parser.parse_args()
+
+    if args.benchmark == "startup":
+        record(benchStartup(args.repeat, max(args.users, 1)), args.record)
+    elif args.benchmark == "reserve":
+        record(benchReserve(args.repeat), args.record)
+    elif args.benchmark == "memory":
+        record(benchMemory(max(args.users, 1), args.targets), args.record)
@@ -0,0 +1,187 @@
+import json
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ratelimit import RateLimiter
+
+KM_PER_DEGREE = 111.32
+EARTH_RADIUS_KM = 6371.0
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+GEOHASH_PRECISION = 5  # cells of ~4.9km x 4.9km
+
+DISCOVERY_BUCKET = "NearBy"
+PAGE_SIZE = 50
+MAX_PAGES = 10
+
+logger = logging.getLogger("discovery")
+
+
+def geohash(latitude: float, longitude: float, precision: int = GEOHASH_PRECISION) -> str:
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    res, bits, char, even = "", 0, 0, True
+    while len(res) < precision:
+        rng, value = (lon_range, longitude) if even else (lat_range, latitude)
+        mid = (rng[0] + rng[1]) / 2
+        char <<= 1
+        if value >= mid:
+            char |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            res += GEOHASH_ALPHABET[char]
+            bits, char = 0, 0
+    return res
+
+
+def geohashCellSize(precision: int = GEOHASH_PRECISION) -> tuple[float, float]:
+    lon_bits = math.ceil(precision * 5 / 2)
+    lat_bits = precision * 5 // 2
+    return 180 / 2 ** lat_bits, 360 / 2 ** lon_bits
+
+
+def distanceKm(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi, dlambda = phi2 - phi1, math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def offset(origin: dict[str, float], dx_km: float, dy_km: float) -> dict[str, float]:
+    latitude = origin["latitude"] + dy_km / KM_PER_DEGREE
+    longitude = origin["longitude"] + dx_km / (KM_PER_DEGREE * max(math.cos(math.radians(origin["latitude"])), 1e-6))
+    return {"latitude": latitude, "longitude": longitude}
+
+
+def tileCenters(origin: dict[str, float], radius_km: float, tile_km: float) -> list[dict[str, float]]:
+    # hexagonal layout of overlapping circles of radius tile_km covering the circle of radius radius_km
+    spacing = tile_km * math.sqrt(3)
+    rows = math.ceil(radius_km / (spacing * math.sqrt(3) / 2)) + 1
+    cols = math.ceil(radius_km / spacing) + 1
+    centers = []
+    for row in range(-rows, rows + 1):
+        dy = row * spacing * math.sqrt(3) / 2
+        shift = spacing / 2 if row % 2 else 0
+        for col in range(-cols, cols + 1):
+            dx = col * spacing + shift
+            if math.hypot(dx, dy) <= radius_km + tile_km:
+                centers.append(offset(origin, dx, dy))
+    return centers
+
+
+class StoreCatalogue:
+    def __init__(self, fname: str):
+        self.fname = fname
+        self.stores: dict[str, dict] = {}
+        self.cells: dict[str, set[str]] = {}
+        self.lock = threading.Lock()  # shared between chats, scans write from worker threads
+        self.load()
+
+    def add(self, item: dict) -> bool:
+        try:
+            item_id = str(item["item"]["item_id"])
+            location = item["store"]["store_location"]["location"]
+            latitude, longitude = float(location["latitude"]), float(location["longitude"])
+        except (KeyError, TypeError, ValueError):
+            return False
+        previous = self.stores.get(item_id)
+        if previous:
+            self.cells.get(previous["geohash"], set()).discard(item_id)
+        cell = geohash(latitude, longitude)
+        self.stores[item_id] = {
+            "item_id": item_id,
+            "display_name": item.get("display_name", ""),
+            "store_name": item.get("store", {}).get("store_name", ""),
+            "latitude": latitude,
+            "longitude": longitude,
+            "geohash": cell,
+            "updated": time.time(),
+        }
+        self.cells.setdefault(cell, set()).add(item_id)
+        return previous is None
+
+    def nearby(self, latitude: float, longitude: float, radius_km: float) -> list[tuple[float, dict]]:
+        lat_step, lon_step = geohashCellSize()
+        dlat = radius_km / KM_PER_DEGREE
+        dlon = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 1e-6))
+        cells = set()
+        lat = latitude - dlat
+        while lat <= latitude + dlat + lat_step:
+            lon = longitude - dlon
+            while lon <= longitude + dlon + lon_step:
+                cells.add(geohash(min(max(lat, -90), 90), ((lon + 180) % 360) - 180))
+                lon += lon_step
+            lat += lat_step
+        res = []
+        with self.lock:
+            for cell in cells:
+                for item_id in self.cells.get(cell, ()):
+                    store = self.stores[item_id]
+                    distance = distanceKm(latitude, longitude, store["latitude"], store["longitude"])
+                    if distance <= radius_km:
+                        res.append((distance, store))
+        return sorted(res, key=lambda entry: entry[0])
+
+    def search(self, name: str) -> list[dict]:
+        name = name.lower()
+        with self.lock:
+            return [store for store in self.stores.values()
+                    if name in store["display_name"].lower() or name in store["store_name"].lower()]
+
+    def save(self) -> None:
+        with self.lock:
+            stores = list(self.stores.values())
+        with open(self.fname, "w") as outfile:
+            json.dump(stores, outfile)
+
+    def load(self) -> None:
+        try:
+            with open(self.fname, "r") as infile:
+                for store in json.load(infile):
+                    self.stores[store["item_id"]] = store
+                    self.cells.setdefault(store["geohash"], set()).add(store["item_id"])
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+
+def scanTile(api, limiter: RateLimiter, center: dict[str, float], tile_km: float) -> list[dict]:
+    items = []
+    for page in range(MAX_PAGES):
+        limiter.acquire()
+        bucket = api.listBucket(type=DISCOVERY_BUCKET, radius=tile_km, page=page, page_size=PAGE_SIZE, origin=center).json()
+        page_items = bucket.get("mobile_bucket", {}).get("items", [])
+        items.extend(page_items)
+        if len(page_items) < PAGE_SIZE:
+            break
+    return items
+
+
+def discover(api, catalogue: StoreCatalogue, origin: dict[str, float], radius_km: float,
+             tile_km: float = 5.0, rate: float = 2.0, workers: int = 4) -> tuple[int, int, int]:
+    # returns (number of tiles, number of new stores, number of failed tiles), a failed tile doesn't stop the sweep
+    limiter = RateLimiter(rate, burst=workers)
+    centers = tileCenters(origin, radius_km, tile_km)
+    seen: dict[str, dict] = {}
+    errors = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(scanTile, api, limiter, center, tile_km) for center in centers]
+        for center, future in zip(centers, futures):
+            try:
+                items = future.result()
+            except Exception as error:
+                logger.warning("Failed to scan the tile around %.4f,%.4f: %s", center["latitude"], center["longitude"], error)
+                errors.append(error)
+                continue
+            for item in items:
+                seen.setdefault(str(item.get("item", {}).get("item_id")), item)
+    if errors and len(errors) == len(centers):
+        raise errors[0]
+    with catalogue.lock:
+        new = sum(catalogue.add(item) for item in seen.values())
+    catalogue.save()
+    return len(centers), new, len(errors)
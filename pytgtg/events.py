@@ -0,0 +1,166 @@
+import abc
+import asyncio
+import dataclasses
+import json
+import logging
+import time
+from typing import Iterable
+
+APPEARED = "appeared"
+QUANTITY_CHANGED = "quantity_changed"
+SOLD_OUT = "sold_out"
+
+BUS_QUEUE_SIZE = 10_000
+SINK_QUEUE_SIZE = 1_000
+BATCH_SIZE = 100
+BATCH_WINDOW = 0.5  # seconds a sink waits to fill a batch
+
+
+@dataclasses.dataclass(slots=True)
+class ItemEvent:
+    kind: str
+    chat_id: int
+    item_id: str
+    display_name: str
+    available: int
+    previous: int
+    price: str
+    purchase_end: str | None
+    time: float
+
+
+def diffItems(chat_id: int, state: dict[str, dict], matches: dict[str, dict]) -> list[ItemEvent]:
+    # compares a poll with the last known state of each item, updates the state in place
+    events = []
+    now = time.time()
+    for item_id, match in matches.items():
+        available = match.get("available", 0)
+        purchase_end = match.get("purchase_end")
+        previous = state.get(item_id)
+        if not isinstance(previous, dict):
+            previous = None
+        before = previous.get("available", 0) if previous else 0
+        if available > 0 and (previous is None or before == 0 or previous.get("purchase_end") != purchase_end):
+            kind = APPEARED
+        elif available > 0 and available != before:
+            kind = QUANTITY_CHANGED
+        elif available == 0 and before > 0:
+            kind = SOLD_OUT
+        else:
+            kind = ""
+        if kind:
+            events.append(ItemEvent(kind, chat_id, item_id, match.get("display_name", ""), available, before,
+                                    match.get("price", ""), purchase_end, now))
+        state[item_id] = {"available": available, "purchase_end": purchase_end}
+    return events
+
+
+def groupByChat(batch: list[ItemEvent]) -> dict[int, list[ItemEvent]]:
+    chats: dict[int, list[ItemEvent]] = {}
+    for event in batch:
+        chats.setdefault(event.chat_id, []).append(event)
+    return chats
+
+
+class Sink(abc.ABC):
+    kinds: frozenset[str] = frozenset((APPEARED, QUANTITY_CHANGED, SOLD_OUT))
+
+    def __init__(self, name: str):
+        self.name = name
+        self.queue: asyncio.Queue[ItemEvent] = asyncio.Queue(SINK_QUEUE_SIZE)
+        self.dropped = 0
+
+    def offer(self, event: ItemEvent) -> None:
+        if event.kind not in self.kinds:
+            return
+        if self.queue.full():  # a slow sink loses its oldest events instead of stalling the others
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+    async def run(self) -> None:
+        while True:
+            batch = [await self.queue.get()]
+            deadline = asyncio.get_running_loop().time() + BATCH_WINDOW
+            while len(batch) < BATCH_SIZE:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self.deliver(batch)
+
+    async def deliver(self, batch: list[ItemEvent]) -> None:
+        try:
+            await self.handle(batch)
+        except Exception as e:
+            logging.error("Event sink %s failed to handle %s events: %s", self.name, len(batch), e)
+
+    async def drain(self) -> None:
+        batch = []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        if batch:
+            await self.deliver(batch)
+
+    @abc.abstractmethod
+    async def handle(self, batch: list[ItemEvent]) -> None:
+        ...
+
+
+class NdjsonSink(Sink):
+    def __init__(self, fname: str):
+        super().__init__("ndjson")
+        self.fname = fname
+
+    async def handle(self, batch: list[ItemEvent]) -> None:
+        lines = "".join(json.dumps(dataclasses.asdict(event), ensure_ascii=False) + "\n" for event in batch)
+        await asyncio.to_thread(self.write, lines)
+
+    def write(self, lines: str) -> None:
+        with open(self.fname, "a", encoding="utf-8") as outfile:
+            outfile.write(lines)
+
+
+class EventBus:
+    # publish() is one non-blocking put, a dispatcher task fans the events out to every sink's own queue
+    def __init__(self, sinks: Iterable[Sink] = ()):
+        self.sinks = list(sinks)
+        self.queue: asyncio.Queue[ItemEvent] = asyncio.Queue(BUS_QUEUE_SIZE)
+        self.tasks: list[asyncio.Task] = []
+        self.dropped = 0
+
+    def publish(self, events: Iterable[ItemEvent]) -> None:
+        for event in events:
+            try:
+                self.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self.dropped += 1
+
+    async def dispatch(self) -> None:
+        dispatched = 0
+        while True:
+            event = await self.queue.get()
+            for sink in self.sinks:
+                sink.offer(event)
+            dispatched += 1
+            if dispatched % BATCH_SIZE == 0:
+                await asyncio.sleep(0)  # let the sinks take their batches during bursts
+
+    def start(self) -> None:
+        self.tasks = [asyncio.create_task(self.dispatch())]
+        self.tasks += [asyncio.create_task(sink.run()) for sink in self.sinks]
+
+    async def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        while not self.queue.empty():
+            event = self.queue.get_nowait()
+            for sink in self.sinks:
+                sink.offer(event)
+        for sink in self.sinks:
+            await sink.drain()
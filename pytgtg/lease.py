@@ -0,0 +1,76 @@
+import math
+import sqlite3
+import time
+import uuid
+
+DEFAULT_PARTITIONS = 64
+DEFAULT_LEASE_TTL = 15.0
+UPDATES_LEASE = -1  # pseudo partition held by the node consuming Telegram updates
+
+
+class LeaseStore:
+    def __init__(self, db_fname: str, node_id: str | None = None, partitions: int = DEFAULT_PARTITIONS, ttl: float = DEFAULT_LEASE_TTL):
+        self.db_fname = db_fname
+        self.node_id = node_id or uuid.uuid4().hex[:12]
+        self.partitions = partitions
+        self.ttl = ttl
+        self.owned: set[int] = set()
+        self.db = sqlite3.connect(db_fname, timeout=ttl / 3, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS nodes (node_id TEXT PRIMARY KEY, heartbeat REAL NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS leases (partition INTEGER PRIMARY KEY, owner TEXT, expires REAL NOT NULL DEFAULT 0)")
+        self.db.executemany("INSERT OR IGNORE INTO leases (partition) VALUES (?)",
+                            ((p,) for p in [UPDATES_LEASE, *range(partitions)]))
+
+    def partitionOf(self, chat_id: int) -> int:
+        return chat_id % self.partitions
+
+    def owns(self, chat_id: int) -> bool:
+        return self.partitionOf(chat_id) in self.owned
+
+    def hasUpdatesLease(self) -> bool:
+        return UPDATES_LEASE in self.owned
+
+    def renew(self) -> tuple[set[int], set[int]]:
+        # heartbeat, keep our leases alive, hand back partitions above our fair share and claim expired ones
+        now = time.time()
+        expires = now + self.ttl
+        previous = self.owned
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.execute("INSERT OR REPLACE INTO nodes (node_id, heartbeat) VALUES (?, ?)", (self.node_id, now))
+            self.db.execute("DELETE FROM nodes WHERE heartbeat < ?", (now - self.ttl,))
+            live_nodes = self.db.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+            share = math.ceil(self.partitions / max(live_nodes, 1))
+
+            self.db.execute("UPDATE leases SET expires = ? WHERE owner = ? AND expires >= ?", (expires, self.node_id, now))
+            held = [row[0] for row in self.db.execute(
+                "SELECT partition FROM leases WHERE owner = ? AND expires >= ? AND partition >= 0 ORDER BY partition", (self.node_id, now))]
+            for partition in held[share:]:
+                self.db.execute("UPDATE leases SET owner = NULL, expires = 0 WHERE partition = ?", (partition,))
+            held = held[:share]
+
+            free = [row[0] for row in self.db.execute(
+                "SELECT partition FROM leases WHERE expires < ? ORDER BY partition", (now,))]
+            for partition in free:
+                if partition >= 0 and len(held) >= share:
+                    continue
+                self.db.execute("UPDATE leases SET owner = ?, expires = ? WHERE partition = ?", (self.node_id, expires, partition))
+                if partition >= 0:
+                    held.append(partition)
+
+            self.owned = {row[0] for row in self.db.execute(
+                "SELECT partition FROM leases WHERE owner = ? AND expires >= ?", (self.node_id, now))}
+            self.db.execute("COMMIT")
+        except sqlite3.Error:
+            self.db.execute("ROLLBACK")
+            raise
+        return self.owned - previous, previous - self.owned
+
+    def release(self) -> None:
+        self.db.execute("UPDATE leases SET owner = NULL, expires = 0 WHERE owner = ?", (self.node_id,))
+        self.db.execute("DELETE FROM nodes WHERE node_id = ?", (self.node_id,))
+        self.owned = set()
+
+    def close(self) -> None:
+        self.db.close()
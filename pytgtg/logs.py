@@ -0,0 +1,50 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+STANDARD_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+STRUCTURED_FIELDS = ("chat_id", "endpoint")
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # the listener lives in this process, so records are queued as is and only formatted on its thread
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setupLogging(fname: str, max_bytes: int, backups: int) -> logging.handlers.QueueListener:
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter(STANDARD_FORMAT))
+    logfile = logging.handlers.RotatingFileHandler(fname, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+    logfile.setFormatter(JsonFormatter())
+
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(records))
+
+    listener = logging.handlers.QueueListener(records, console, logfile, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
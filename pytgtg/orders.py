@@ -0,0 +1,71 @@
+import bisect
+import json
+
+# states an order doesn't leave anymore, the others are refreshed on every sync
+FINAL_STATES = frozenset(("REDEEMED", "PICKED_UP", "CANCELLED", "CANCELED", "EXPIRED", "ABORTED", "REFUNDED", "NOT_COLLECTED"))
+
+
+class OrderCache:
+    # local copy of the order history, indexed by order_id, store and purchase date
+    def __init__(self, fname: str):
+        self.fname = fname
+        self.orders: dict[str, dict] = {}
+        self.by_store: dict[str, list[str]] = {}
+        self.by_date: list[tuple[str, str]] = []  # sorted (time_of_purchase, order_id)
+        self.load()
+
+    def add(self, order: dict) -> None:
+        order_id = str(order.get("order_id"))
+        if order_id in self.orders:
+            self.orders[order_id] = order
+            return
+        self.orders[order_id] = order
+        self.by_store.setdefault(str(order.get("store_name", "")).lower(), []).append(order_id)
+        bisect.insort(self.by_date, (order.get("time_of_purchase", ""), order_id))
+
+    def sync(self, api) -> list[dict]:
+        # the API lists the most recent orders first: stop at a known final order once every open one was refreshed
+        pending = {order_id for order_id, order in self.orders.items() if order.get("state") not in FINAL_STATES}
+        new, changed = [], False
+        for order in api.iterOrders():
+            order_id = str(order.get("order_id"))
+            known = self.orders.get(order_id)
+            if known is None:
+                new.append(order)
+            changed = changed or known != order
+            self.add(order)
+            pending.discard(order_id)
+            if known is not None and order.get("state") in FINAL_STATES and not pending:
+                break
+        if changed:
+            self.save()
+        return new
+
+    def get(self, order_id: str) -> dict | None:
+        return self.orders.get(str(order_id))
+
+    def byStore(self, store_name: str) -> list[dict]:
+        name = store_name.lower()
+        return [self.orders[order_id] for store, ids in self.by_store.items() if name in store for order_id in ids]
+
+    def between(self, start: str, end: str) -> list[dict]:
+        # ISO 8601 dates, end is exclusive
+        lo = bisect.bisect_left(self.by_date, (start, ""))
+        hi = bisect.bisect_left(self.by_date, (end, ""))
+        return [self.orders[order_id] for _, order_id in self.by_date[lo:hi]]
+
+    def latest(self, count: int | None = None) -> list[dict]:
+        ids = [order_id for _, order_id in reversed(self.by_date)]
+        return [self.orders[order_id] for order_id in ids[:count]]
+
+    def save(self) -> None:
+        with open(self.fname, "w") as outfile:
+            json.dump(list(self.orders.values()), outfile)
+
+    def load(self) -> None:
+        try:
+            with open(self.fname, "r") as infile:
+                for order in json.load(infile):
+                    self.add(order)
+        except (FileNotFoundError, ValueError):
+            pass
@@ -0,0 +1,65 @@
+import asyncio
+import os
+import signal
+import sys
+import threading
+from collections import Counter
+
+SAMPLE_INTERVAL = 0.01  # seconds of CPU time used by the process
+MAX_DEPTH = 128
+
+
+def profilingSupported() -> bool:
+    return hasattr(signal, "setitimer") and hasattr(signal, "SIGPROF")
+
+
+def frameName(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def taskName(task: asyncio.Task | None) -> str:
+    if task is None:
+        return "task:none"
+    return f"task:{getattr(task.get_coro(), '__qualname__', task.get_name())}"
+
+
+class SamplingProfiler:
+    # SIGPROF fires every SAMPLE_INTERVAL of CPU time and the handler records the stack of every thread.
+    # No handler and no timer are installed while it is stopped. Must be started and stopped from the main thread.
+    def __init__(self, loop: asyncio.AbstractEventLoop | None = None, interval: float = SAMPLE_INTERVAL):
+        self.loop = loop
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+        self.previous_handler = None
+
+    def sample(self, signum, current) -> None:
+        main = threading.get_ident()
+        threads = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == main:
+                frame = current  # the frame the signal interrupted, not this handler
+            stack = []
+            while frame is not None and len(stack) < MAX_DEPTH:
+                stack.append(frameName(frame))
+                frame = frame.f_back
+            root = [f"thread:{threads.get(thread_id, thread_id)}"]
+            if thread_id == main and self.loop is not None:
+                root.append(taskName(asyncio.current_task(self.loop)))  # the coroutine the event loop was running
+            self.stacks[";".join(root + stack[::-1])] += 1
+        self.samples += 1
+
+    def start(self) -> None:
+        self.previous_handler = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self) -> None:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self.previous_handler or signal.SIG_DFL)
+
+    def write(self, fname: str) -> None:
+        # folded stacks, one "frame;frame;frame count" line per stack, for flamegraph.pl or speedscope
+        with open(fname, "w") as outfile:
+            for stack, count in sorted(self.stacks.items()):
+                outfile.write(f"{stack} {count}\n")
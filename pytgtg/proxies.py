@@ -0,0 +1,115 @@
+import logging
+import os
+import threading
+import time
+
+import httpx
+
+EWMA_ALPHA = 0.2
+MIN_REQUESTS = 5  # before a proxy can be judged
+MAX_BLOCK_RATE = 0.4  # share of recent 403/429 responses
+MAX_ERROR_RATE = 0.5  # share of recent connection errors
+COOLDOWN = 600.0
+MAX_CONNECTIONS = 50
+
+
+class Proxy:
+    def __init__(self, url: str):
+        self.url = url
+        self.transport = httpx.HTTPTransport(
+            proxy=url, limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS // 2)
+        )
+        self.accounts: set[str] = set()
+        self.reset()
+
+    def reset(self) -> None:
+        self.requests = 0
+        self.latency = 0.0
+        self.block_rate = 0.0
+        self.error_rate = 0.0
+        self.cooldown_until = 0.0
+
+    def record(self, latency: float, status: int | None) -> None:
+        self.requests += 1
+        blocked = status in (403, 429)
+        failed = status is None
+        if status is not None:
+            self.latency = latency if self.requests == 1 else (1 - EWMA_ALPHA) * self.latency + EWMA_ALPHA * latency
+        self.block_rate = (1 - EWMA_ALPHA) * self.block_rate + EWMA_ALPHA * blocked
+        self.error_rate = (1 - EWMA_ALPHA) * self.error_rate + EWMA_ALPHA * failed
+
+    def isHealthy(self, now: float) -> bool:
+        if self.cooldown_until > now:
+            return False
+        if self.requests < MIN_REQUESTS:
+            return True
+        return self.block_rate <= MAX_BLOCK_RATE and self.error_rate <= MAX_ERROR_RATE
+
+    def score(self) -> float:
+        # lower is better
+        return (self.latency or 1.0) * (1 + 10 * self.block_rate + 5 * self.error_rate)
+
+    def host(self) -> str:
+        return self.url.rsplit("@", 1)[-1]
+
+
+class ProxyPool:
+    # accounts stick to their proxy until it turns unhealthy, then move to the least loaded healthy proxy
+    def __init__(self, urls: list[str]):
+        self.proxies = {url: Proxy(url) for url in dict.fromkeys(urls)}
+        self.assignments: dict[str, Proxy] = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def fromEnv(cls) -> "ProxyPool | None":
+        urls = [url.strip() for url in os.getenv("TGTG_PROXIES", "").split(",") if url.strip()]
+        fname = os.getenv("TGTG_PROXY_FILE")
+        if fname:
+            urls += cls.readFile(fname)
+        return cls(urls) if urls else None
+
+    @staticmethod
+    def readFile(fname: str) -> list[str]:
+        with open(fname, "r") as infile:
+            return [line.strip() for line in infile if line.strip() and not line.startswith("#")]
+
+    def assign(self, account: str) -> Proxy | None:
+        now = time.time()
+        with self.lock:
+            current = self.assignments.get(account)
+            if current and current.isHealthy(now):
+                return current
+            candidates = [proxy for proxy in self.proxies.values() if proxy.isHealthy(now)]
+            if not candidates:  # everything is cooling down, use the one that recovers first
+                candidates = [min(self.proxies.values(), key=lambda proxy: proxy.cooldown_until, default=None)]
+            proxy = min(candidates, key=lambda proxy: (len(proxy.accounts), proxy.score()), default=None) # type: ignore
+            if current:
+                current.accounts.discard(account)
+            if proxy:
+                proxy.accounts.add(account)
+                self.assignments[account] = proxy
+            return proxy
+
+    def report(self, url: str, latency: float, status: int | None) -> bool:
+        # returns whether the proxy is still healthy
+        now = time.time()
+        with self.lock:
+            proxy = self.proxies.get(url)
+            if proxy is None:
+                return False
+            proxy.record(latency, status)
+            if proxy.isHealthy(now):
+                return True
+            if proxy.cooldown_until <= now:
+                logging.warning("Proxy %s is unhealthy (403/429: %.0f%%, errors: %.0f%%), rotating it out for %ss",
+                                proxy.host(), proxy.block_rate * 100, proxy.error_rate * 100, COOLDOWN)
+                proxy.reset()
+                proxy.cooldown_until = now + COOLDOWN
+            return False
+
+    def stats(self) -> list[dict]:
+        now = time.time()
+        with self.lock:
+            return [{"proxy": proxy.host(), "accounts": len(proxy.accounts), "healthy": proxy.isHealthy(now),
+                     "latency": proxy.latency, "block_rate": proxy.block_rate, "error_rate": proxy.error_rate}
+                    for proxy in self.proxies.values()]
@@ -0,0 +1,129 @@
+import dataclasses
+import datetime
+import re
+
+WILDCARD = "*"
+FILTERS = ("max_price", "pickup", "store")
+PICKUP_PATTERN = re.compile(r"^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$")
+
+
+def parsePickup(window: str) -> tuple[int, int]:
+    # "18:00-20:30" -> minutes of the day, the end may be after midnight
+    match = PICKUP_PATTERN.match(window.strip())
+    if not match:
+        raise ValueError(f"Invalid pickup window: {window}")
+    h1, m1, h2, m2 = (int(group) for group in match.groups())
+    if h1 > 23 or h2 > 23 or m1 > 59 or m2 > 59:
+        raise ValueError(f"Invalid pickup window: {window}")
+    start, end = h1 * 60 + m1, h2 * 60 + m2
+    return start, end if end > start else end + 1440
+
+
+def parseFilters(text: str) -> dict:
+    # "max_price=4.5 pickup=18:00-20:00 store=Some Bakery", the store name runs to the next filter
+    parts = re.split(rf"(?:^|\s)({'|'.join(FILTERS)})=", text.strip())
+    if parts[0].strip():
+        raise ValueError(f"Unknown filter: {parts[0].strip()}")
+    filters = {}
+    for name, value in zip(parts[1::2], parts[2::2]):
+        value = value.strip()
+        if name == "max_price":
+            filters[name] = float(value.replace(",", "."))
+            if filters[name] <= 0:
+                raise ValueError("The maximum price must be positive")
+        elif name == "pickup":
+            parsePickup(value)
+            filters[name] = value
+        elif value:
+            filters[name] = value
+        else:
+            raise ValueError("Empty store name")
+    return filters
+
+
+def describeFilters(target: dict) -> str:
+    filters = []
+    if target.get("max_price") is not None:
+        filters.append(f"≤ {target['max_price']:.2f}")
+    if target.get("pickup"):
+        filters.append(f"pickup {target['pickup']}")
+    if target.get("store"):
+        filters.append(f"store \"{target['store']}\"")
+    return ", ".join(filters)
+
+
+def localMinutes(timestamp: str, tz: datetime.tzinfo | None = None) -> int:
+    # in tz, the server's local time by default
+    moment = datetime.datetime.fromisoformat(timestamp).astimezone(tz)
+    return moment.hour * 60 + moment.minute
+
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class Rule:
+    key: str  # the target this rule was compiled from
+    max_price: float | None = None
+    pickup: tuple[int, int] | None = None  # minutes of the day, in the user's timezone
+    store: str | None = None  # lower case
+
+    @classmethod
+    def compile(cls, key: str, target: dict) -> "Rule":
+        max_price = target.get("max_price")
+        pickup = target.get("pickup")
+        store = target.get("store")
+        return cls(key, float(max_price) if max_price is not None else None,
+                   parsePickup(pickup) if pickup else None, store.lower() if store else None)
+
+    def accepts(self, item: dict, tz: datetime.tzinfo | None = None) -> bool:
+        if self.max_price is not None:
+            price = item.get("item", {}).get("item_price") or {}
+            if price and price.get("minor_units", 0) / 10 ** price.get("decimals", 0) > self.max_price:
+                return False
+        if self.store is not None:
+            names = f"{(item.get('store') or {}).get('store_name', '')}\n{item.get('display_name', '')}"
+            if self.store not in names.lower():
+                return False
+        if self.pickup is not None:
+            interval = item.get("pickup_interval")
+            if interval:  # sold out items come without one
+                start, end = localMinutes(interval["start"], tz), localMinutes(interval["end"], tz)
+                if end <= start:
+                    end += 1440
+                if not any(start < self.pickup[1] + shift and self.pickup[0] + shift < end for shift in (-1440, 0, 1440)):
+                    return False
+        return True
+
+
+class MatchRules:
+    # targets compiled once when they change: item ids are a dict lookup, the wildcard rules are tried in order
+    def __init__(self, targets: dict[str, dict], tz: datetime.tzinfo | None = None):
+        self.tz = tz
+        self.items: dict[str, Rule] = {}
+        self.wildcards: list[Rule] = []
+        for key, target in targets.items():
+            rule = Rule.compile(key, target)
+            if key == WILDCARD:
+                self.wildcards.append(rule)
+            else:
+                self.items[key] = rule
+
+    def __bool__(self) -> bool:
+        return bool(self.items or self.wildcards)
+
+    def evaluate(self, items: list[dict], minQty: int) -> tuple[list[tuple[str, int]], list[tuple[str, dict, Rule]]]:
+        # one pass over a page: the (item_id, available) of every targeted item and the (item_id, item, rule) of the matches
+        targeted, matches = [], []
+        for item in items:
+            item_id = str(item.get("item", {}).get("item_id"))
+            rule = self.items.get(item_id)
+            candidates = (rule,) if rule is not None else self.wildcards
+            if not candidates:
+                continue
+            available = item.get("items_available", 0)
+            targeted.append((item_id, available))
+            if available < minQty:
+                continue
+            for candidate in candidates:
+                if candidate.accepts(item, self.tz):
+                    matches.append((item_id, item, candidate))
+                    break
+        return targeted, matches
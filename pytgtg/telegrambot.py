@@ -1,30 +1,38 @@
 import asyncio
 import datetime
+import html
 from logging import shutdown
-from dateutil import parser
 import logging.config
 import os
 import pathlib
 import random
 import re
 import shutil
+import signal
 import json
+import time
 from pathlib import Path
 from typing import Self, Callable, Dict
-
-import aiosmtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 from telegram import Bot, Update, ChatPermissions
 from telegram import constants, helpers, error
-from telegram.ext import (ApplicationBuilder, CallbackContext, CommandHandler,
-                          MessageHandler, filters, Application)
+from telegram.ext import (ApplicationBuilder, CallbackContext, CommandHandler, ChatMemberHandler,
+                          MessageHandler, filters, Application, BaseUpdateProcessor)
 
 from api import TooGoodToGoApi
+from discovery import StoreCatalogue, discover
+from events import APPEARED, EventBus, ItemEvent, NdjsonSink, Sink, diffItems, groupByChat
+from timeseries import AvailabilityLog
+from orders import OrderCache
+from proxies import ProxyPool
+from logs import setupLogging
+from profiler import SamplingProfiler, profilingSupported
+from rules import FILTERS, MatchRules, describeFilters, parseFilters
+from lease import DEFAULT_LEASE_TTL, DEFAULT_PARTITIONS, LeaseStore
 from exceptions import (TgtgConnectionError, TgtgForbiddenError,
                         TgtgLoggedOutError, TgtgUnauthorizedError,
-                        TgtgBadRequestError)
+                        TgtgBadRequestError, TgtgOrderError)
 
 MAX_REQUESTS = 1_000_000
 MODULO_REQUESTS_TO_LOG = 140
@@ -33,7 +41,59 @@ MAX_FAILED_REQUESTS = 3
 
 DEFAULT_WATCH_INTERVAL = 15.0
 
+BURST_INTERVAL = 2.0  # polling one hot item around its drop
+BURST_DURATION = 60.0
+BURST_BUDGET = 150  # getItemInfo calls per account and hour
+BURST_COOLDOWN = 900.0  # before the same item can burst again
+BURST_WINDOW = 10  # minutes around an item's usual drop time
+
 RESURECTION_INTERVAL = 300
+RESURECTION_CONCURRENCY = 8
+RESURECTION_JITTER = 10.0  # spread revivals over a few seconds instead of reviving everyone at once
+
+CLUSTER_DB = os.getenv("TGTG_CLUSTER_DB")  # shared lease database, enables multi-node mode
+NODE_ID = os.getenv("TGTG_NODE_ID")
+PARTITIONS = int(os.getenv("TGTG_PARTITIONS", DEFAULT_PARTITIONS))
+LEASE_RENEW_INTERVAL = DEFAULT_LEASE_TTL / 3
+
+WEBHOOK_URL = os.getenv("TGTG_WEBHOOK_URL")  # public url, enables webhook mode instead of polling
+WEBHOOK_LISTEN = os.getenv("TGTG_WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("TGTG_WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.getenv("TGTG_WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("TGTG_WEBHOOK_SECRET")
+WEBHOOK_CERT = os.getenv("TGTG_WEBHOOK_CERT")  # serve HTTPS directly when a certificate and key are provided
+WEBHOOK_KEY = os.getenv("TGTG_WEBHOOK_KEY")
+CONCURRENT_UPDATES = int(os.getenv("TGTG_CONCURRENT_UPDATES", 64))
+PENDING_UPDATES = 10_000  # updates waiting for their chat or a slot
+ALLOWED_UPDATES = list(Update.ALL_TYPES)  # chat_member isn't sent unless asked for
+
+ADMINS_CACHE_TTL = 600.0  # group administrators, also dropped when a member is promoted or demoted
+
+BULK_CONCURRENCY = 5  # parallel TGTG calls per bulk command
+
+CATALOGUE_FNAME = f"catalogue_{NODE_ID}.json" if NODE_ID else "catalogue.json"  # stores found by /discover, shared by every chat
+DISCOVERY_MAX_RADIUS = 30.0
+DISCOVERY_TILE_KM = 5.0
+DISCOVERY_RATE = 2.0
+DISCOVERY_WORKERS = 4
+
+AVAILABILITY_LOG = f"availability_{NODE_ID}" if NODE_ID else "availability"  # prefix of the columnar availability log files
+ORDER_CACHE_FNAME = f"orders_{{chat_id}}_{NODE_ID}.json" if NODE_ID else "orders_{chat_id}.json"
+
+CHECKPOINT_FNAME = f"checkpoint_{NODE_ID}.json" if NODE_ID else "checkpoint.json"
+CHECKPOINT_MAX_AGE = 3600  # older runtime state is discarded on startup
+
+SNAPSHOT_MAX_AGE = float(os.getenv("TGTG_SNAPSHOT_MAX_AGE", 60))  # /dry_run and /status reuse a poll this recent
+
+DASHBOARD_DEBOUNCE = 10.0  # seconds between two edits of a chat's dashboard
+
+EVENTS_FILE = os.getenv("TGTG_EVENTS_FILE")  # also write every item event to this NDJSON file
+
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("TGTG_ADMIN_IDS", "").split(",") if user_id.strip()}  # Telegram user ids allowed to /profile
+PROFILE_DURATION = 30.0  # seconds, also used by SIGUSR1
+PROFILE_MAX_DURATION = 300.0
+
+PROXY_POOL = ProxyPool.fromEnv()  # TGTG_PROXIES and/or TGTG_PROXY_FILE, direct connections otherwise
 
 PATH = pathlib.Path(__file__).parent.resolve()
 
@@ -41,29 +101,16 @@ LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 if LOG_LEVEL not in ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"):
     LOG_LEVEL = "INFO"
 
+LOG_FILE = os.getenv("LOG_FILE", "telegrambot.log")  # JSON lines, rotated by size
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10_000_000))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", 5))
+
+# handlers are attached by setupLogging, behind a queue drained by a background thread
 LOGGER_CONFIG = {
     'version': 1,
-    'formatters': {
-        'standard': {
-            'format': '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-        }
-    },
-    'handlers': {
-        'console': {
-            'class': 'logging.StreamHandler',
-            'formatter': 'standard',
-            'stream': 'ext://sys.stdout'
-        },
-        'file': {
-            'class': 'logging.FileHandler',
-            'formatter': 'standard',
-            'filename': 'telegrambot.log',
-            'mode': 'a'
-        }
-    },
+    'disable_existing_loggers': False,
     'root': {
-        'level': LOG_LEVEL,
-        'handlers': ['console', 'file']
+        'level': LOG_LEVEL
     },
     'loggers': {
         'httpx': {
@@ -77,6 +124,10 @@ LOGGER_CONFIG = {
 
 
 class User:
+    __slots__ = ("chat_id", "config_fname", "polling_id", "watch_interval", "watcher", "next_poll", "seen", "order_cache",
+                 "burst_stats", "burst_budget", "burst_cooldowns", "api", "targets", "telegram_config",
+                 "watching", "snapshot", "rules")
+
     def __init__(self, chat_id: int):
         self.chat_id = chat_id
         self.config_fname = f"config_{self.chat_id}.json"
@@ -84,24 +135,57 @@ class User:
         self.polling_id = ""
         self.watch_interval = DEFAULT_WATCH_INTERVAL
         self.watcher: asyncio.Task
+        self.next_poll = 0.0
         self.seen = {}
+        self.order_cache: OrderCache | None = None
+        self.burst_stats = {"bursts": 0, "caught": 0, "requests": 0}
+        self.burst_budget = (0.0, 0)  # (start of the hour, calls spent)
+        self.burst_cooldowns: dict[str, float] = {}
+        self.snapshot: tuple[float, frozenset[str], dict[str, dict]] | None = None  # (time, targets, matches) of the last poll
         self.api = self.getApi(self.config_fname)
         self.setConfigDefaults()
         self.watching = self.api.config.get("watching", False)
 
     def getApi(self, config_fname: str) -> TooGoodToGoApi:
-        return TooGoodToGoApi(config_fname)
+        return TooGoodToGoApi(config_fname, PROXY_POOL)
+
+    def getOrderCache(self) -> OrderCache:
+        if self.order_cache is None:
+            self.order_cache = OrderCache(ORDER_CACHE_FNAME.format(chat_id=self.chat_id))
+        return self.order_cache
 
     def createConfig(self, f_name: str) -> None:
         if not os.path.exists(f_name):
             shutil.copy(f"{PATH}/config.json.defaults", f_name)
 
+    def isConfigStale(self) -> bool:
+        return self.api.isConfigStale()
+
+    def reloadConfig(self) -> None:
+        # another node may have written this user's config (tokens, targets, watching state)
+        self.api.syncConfig()
+        self.setConfigDefaults()
+        self.watching = self.api.config.get("watching", False)
+
     def setConfigDefaults(self) -> None:
         # self.api.config.setdefault("telegram_username", self.username)
         self.targets = self.api.config.setdefault("targets", {})
         self.api.config.setdefault("telegram_config", {"pinning": False,
                                                        "email_notifications": None})
         self.telegram_config = self.api.config.get("telegram_config")
+        self.compileRules()
+
+    def getTimezone(self) -> ZoneInfo | None:
+        # None is the server's local time
+        try:
+            return ZoneInfo(self.telegram_config["timezone"])
+        except (KeyError, TypeError, ValueError, ZoneInfoNotFoundError):
+            return None
+
+    def compileRules(self) -> None:
+        # call whenever the targets or the timezone change, the last poll was matched with the old rules
+        self.rules = MatchRules(self.targets, self.getTimezone())
+        self.snapshot = None
 
     def toggleWatching(self, watching: bool) -> None:
         self.watching = watching
@@ -117,6 +201,44 @@ class User:
     def shouldWatch(self) -> bool:
         return self.watching
 
+    def getState(self) -> dict:
+        return {"watch_interval": self.watch_interval, "next_poll": self.next_poll, "seen": self.seen,
+                "cookies": self.api.getCookies(), "requests_count": self.api.requests_count}
+
+    def setState(self, state: dict) -> None:
+        self.watch_interval = state.get("watch_interval", DEFAULT_WATCH_INTERVAL)
+        self.next_poll = state.get("next_poll", 0.0)
+        self.seen = state.get("seen", {})
+        self.api.requests_count = state.get("requests_count", 0)
+        self.api.setCookies(state.get("cookies", []))
+
+    def prepareReservations(self) -> None:
+        for item_id, target in self.targets.items():
+            if target.get("auto_reserve") and item_id != "*" and target.get("qty", 1) > 0:
+                self.api.prepareOrder(item_id, target.get("qty", 1))
+
+    def spendBurstBudget(self) -> bool:
+        now = time.time()
+        start, spent = self.burst_budget
+        if now - start > 3600:
+            start, spent = now, 0
+        if spent >= BURST_BUDGET:
+            return False
+        self.burst_budget = (start, spent + 1)
+        return True
+
+    def setSnapshot(self, targets: frozenset[str], matches: dict[str, dict]) -> None:
+        self.snapshot = (time.time(), targets, matches)
+
+    def getSnapshot(self, max_age: float) -> tuple[float, dict[str, dict]] | None:
+        # only valid while it is recent and was polled for the current targets
+        if self.snapshot is None:
+            return None
+        taken, targets, matches = self.snapshot
+        if time.time() - taken > max_age or targets != self.targets.keys():
+            return None
+        return taken, matches
+
     def clearHistory(self) -> None:
         self.seen = {}
 
@@ -132,16 +254,19 @@ class User:
             res += code
         return res
 
-    def matchesDesired(self, item_id: str, targets: set[str]) -> str:
-        if item_id in targets:
-            return item_id
-        if "*" in targets:
-            return "*"
-        return ""
+    def matchEntry(self, item: dict, target: dict) -> dict:
+        return {"display_name": item.get("display_name"),
+                "quantity": target.get("qty"),
+                "available": item.get("items_available", 0),
+                "purchase_end": item.get("purchase_end"),
+                "pickup_interval": item.get("pickup_interval"),
+                "store_id": (item.get("store") or {}).get("store_id"),
+                "price": self.getPrice(item)}
 
-    def getMatches(self, targets: dict[str, dict], minQty: int=1, maxBags: int=250):
+    def getMatches(self, targets: dict[str, dict], minQty: int=1, maxBags: int=250, observer: Callable[[str, int], None] | None=None):
         res = {}
-        if targets == {}:
+        rules = self.rules if targets is self.targets else MatchRules(targets, self.getTimezone())
+        if not rules:
             return res
         page = 0
         page_size = 50
@@ -149,68 +274,348 @@ class User:
             businesses = self.api.listFavoriteBusinesses(page=page, page_size=page_size).json()
             # items = businesses.get("mobile_bucket").get("items") # listBucket()
             items = businesses.get("favourite_items")
-            for item in items:
-                available = item.get("items_available", 0)
-                display_name = item.get("display_name")
-                item_id = str(item.get("item").get("item_id"))
-                if available >= minQty:
-                    match = self.matchesDesired(item_id, set(targets.keys()))
-                    if match:
-                        res[item_id] = {"display_name": display_name,
-                                        "quantity": targets.get(match).get("qty"), # type: ignore
-                                        "available": available,
-                                        "purchase_end": item.get("purchase_end"),
-                                        "pickup_interval": item.get("pickup_interval"),
-                                        "price": self.getPrice(item)}
-                #elif item_id in self.seen:
-                #    self.seen.pop(item_id)  # remove item from seen list in case of a future restock
+            targeted, matches = rules.evaluate(items, minQty)
+            if observer:
+                for item_id, available in targeted:
+                    observer(item_id, available)
+            for item_id, item, rule in matches:
+                res[item_id] = self.matchEntry(item, targets[rule.key])
             if len(items) < page_size:
                 break
             else:
                 page += 1
         return res
 
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    # updates from different chats run concurrently, updates from the same chat run one at a time and in order
+    def __init__(self, max_concurrent_updates: int):
+        # the base class' semaphore is only a ceiling on pending updates, the slots are taken after the chat's lock
+        super().__init__(PENDING_UPDATES)
+        self.slots = asyncio.Semaphore(max_concurrent_updates)
+        self.chat_locks: dict[int, tuple[asyncio.Lock, int]] = {}
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        # the chat's lock is taken before a concurrency slot, updates queued behind a busy chat don't hold slots
+        chat_id = getattr(getattr(update, "effective_chat", None), "id", 0)
+        lock, waiting = self.chat_locks.get(chat_id, (asyncio.Lock(), 0))
+        self.chat_locks[chat_id] = (lock, waiting + 1)
+        try:
+            async with lock, self.slots:
+                await coroutine
+        finally:
+            lock, waiting = self.chat_locks[chat_id]
+            if waiting <= 1:
+                self.chat_locks.pop(chat_id)
+            else:
+                self.chat_locks[chat_id] = (lock, waiting - 1)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class TelegramSink(Sink):
+    kinds = frozenset((APPEARED,))
+
+    def __init__(self, bot: "TooGoodToGoTelegram"):
+        super().__init__("telegram")
+        self.bot = bot
+
+    async def handle(self, batch: list[ItemEvent]) -> None:
+        # one send per chat, concurrently: a slow or rate limited chat doesn't hold back the others
+        await asyncio.gather(*(self.notify(chat_id, events) for chat_id, events in groupByChat(batch).items()))
+
+    async def notify(self, chat_id: int, events: list[ItemEvent]) -> None:
+        user = self.bot.users.get(chat_id)
+        if user is None:
+            return
+        try:
+            # with a dashboard, the alerts aren't pinned
+            await self.bot.sendPinnedMessage(chat_id=chat_id, text=self.bot.eventsText(events), parse_mode=constants.ParseMode.HTML,
+                                             pinned=user.telegram_config.get("pinning") and not user.telegram_config.get("dashboard"))
+        except error.TelegramError as e:
+            logging.error("Failed to notify chat %s: %s", chat_id, e, extra={"chat_id": chat_id})
+
+
+class EmailSink(Sink):
+    kinds = frozenset((APPEARED,))
+
+    def __init__(self, bot: "TooGoodToGoTelegram"):
+        super().__init__("email")
+        self.bot = bot
+
+    async def handle(self, batch: list[ItemEvent]) -> None:
+        for chat_id, events in groupByChat(batch).items():
+            user = self.bot.users.get(chat_id)
+            email = user.telegram_config.get("email_notifications") if user else None
+            if email:
+                await self.bot.send_email(email, self.bot.eventsText(events))
+
+
+class DashboardSink(Sink):
+    # what is available right now, in one pinned message per chat edited at most every DASHBOARD_DEBOUNCE seconds
+    def __init__(self, bot: "TooGoodToGoTelegram"):
+        super().__init__("dashboard")
+        self.bot = bot
+        self.boards: dict[int, dict[str, ItemEvent]] = {}  # chat_id -> item_id -> latest event of an available item
+        self.rendered: dict[int, str] = {}
+        self.edited: dict[int, float] = {}
+        self.pending: dict[int, asyncio.Task] = {}
+
+    async def handle(self, batch: list[ItemEvent]) -> None:
+        for chat_id, events in groupByChat(batch).items():
+            user = self.bot.users.get(chat_id)
+            if user is None or not user.telegram_config.get("dashboard"):
+                continue
+            board = self.board(user)
+            for event in events:
+                if event.available > 0:
+                    board[event.item_id] = event
+                else:
+                    board.pop(event.item_id, None)
+            self.schedule(chat_id)
+
+    def board(self, user: User) -> dict[str, ItemEvent]:
+        board = self.boards.get(user.chat_id)
+        if board is None:  # starts from the last poll, if it is recent and matched the current targets
+            board = self.boards[user.chat_id] = {}
+            taken, matches = user.getSnapshot(SNAPSHOT_MAX_AGE) or (0.0, {})
+            for item_id, match in matches.items():
+                if match.get("available", 0) > 0:
+                    board[item_id] = ItemEvent(APPEARED, user.chat_id, item_id, match.get("display_name", ""), match["available"], 0,
+                                               match.get("price", ""), match.get("purchase_end"), taken)
+        return board
+
+    def redraw(self, user: User) -> None:
+        # for the changes that produce no event: stopped watcher, items hidden by new filters
+        if user.telegram_config.get("dashboard"):
+            self.boards.pop(user.chat_id, None)
+            self.schedule(user.chat_id)
+
+    def schedule(self, chat_id: int) -> None:
+        task = self.pending.get(chat_id)
+        if task is None or task.done():
+            delay = max(self.edited.get(chat_id, 0.0) + DASHBOARD_DEBOUNCE - time.monotonic(), 0)
+            self.pending[chat_id] = asyncio.create_task(self.flush(chat_id, delay))
+
+    async def flush(self, chat_id: int, delay: float = 0) -> None:
+        await asyncio.sleep(delay)
+        self.pending.pop(chat_id, None)
+        user = self.bot.users.get(chat_id)
+        if user is None or not user.telegram_config.get("dashboard"):
+            return
+        text = self.bot.dashboardText(user, self.board(user))
+        if text == self.rendered.get(chat_id):
+            return
+        self.edited[chat_id] = time.monotonic()
+        try:
+            await self.bot.updateDashboard(user, text)
+            self.rendered[chat_id] = text
+        except error.TelegramError as e:
+            logging.error("Failed to update the dashboard of chat %s: %s", chat_id, e, extra={"chat_id": chat_id})
+
+    def forget(self, chat_id: int) -> None:
+        for state in (self.boards, self.rendered, self.edited):
+            state.pop(chat_id, None)
+        task = self.pending.pop(chat_id, None)
+        if task:
+            task.cancel()
+
+    async def drain(self) -> None:
+        await super().drain()
+        for chat_id, task in list(self.pending.items()):  # don't wait for the debounce when stopping
+            task.cancel()
+            await self.flush(chat_id)
+
+
 class TooGoodToGoTelegram:
     def __init__(self, TOKEN: str):
         logging.config.dictConfig(LOGGER_CONFIG)
+        self.log_listener = setupLogging(LOG_FILE, LOG_MAX_BYTES, LOG_BACKUPS)
         self.TOKEN = TOKEN
 
         self.commands: dict[Callable, str] = {self.help: "List available commands", self.set_email: "Set your TGTG email login", self.login: "Request TGTG login",
                          self.login_with_pin: "Login with email PIN",
-                         self.add_target: "Add an item to watch", self.remove_target: "Remove a watched item", self.show_targets: "Show currently watched items",
-                         self.watch: "Start watching items", self.stop_watching: "Stop watching items", self.dry_run: "See favourites magic bags matching targets", self.pin_results: "Pin messages about available Magic Bags",
-                         self.add_favorite: "Add item to your TGTG favorites", self.invite: "Create an order invite for a friend", self.cancel_invite: "Cancel order invite",
+                         self.add_target: "Add an item to watch", self.add_targets: "Add several items to watch", self.remove_target: "Remove a watched item", self.auto_reserve: "Reserve a target as soon as it is available", self.set_filter: "Filter a target by price, pickup time or store", self.show_targets: "Show currently watched items",
+                         self.watch: "Start watching items", self.stop_watching: "Stop watching items", self.dry_run: "See favourites magic bags matching targets", self.pin_results: "Pin messages about available Magic Bags", self.dashboard: "Keep one pinned message with what is available",
+                         self.add_favorite: "Add item to your TGTG favorites", self.add_favorites: "Add several items to your TGTG favorites", self.orders: "List your orders", self.discover: "Scan the stores around you (radius in km)", self.nearby: "Find known stores near you (radius in km, name)", self.restocks: "Restock statistics of your targets (days)", self.invite: "Create an order invite for a friend", self.cancel_invite: "Cancel order invite",
                          self.notify_email: "Notify of matches by email", self.status: "Show the bot's status", self.clear_history: "Clear history for seen items",
                          self.refresh: "Get a new set of tokens", self.random_ua: "Randomly generate a new user agent", self.set_datadome: "Set datadome cookie", 
-                         self.set_location: "Set your location (latitude, longitude)",
+                         self.set_location: "Set your location (latitude, longitude)", self.set_timezone: "Set your timezone (e.g. Europe/Paris)",
                          self.logout: "Close this tgtg session", self.shutdown: "Shut your client down", self.about: "Display bot's info", self.error: "See common errors", self.start: "Welcome"}
         self.users = self.getUsers(r"^config_(.+)\.json$")
+        self.restored = self.restoreCheckpoint()
+        self.leases = LeaseStore(CLUSTER_DB, NODE_ID, PARTITIONS) if CLUSTER_DB else None
+        self.live_watchers: set[int] = set()
+        self.reviving: set[int] = set()
+        self.resurection_slots = asyncio.Semaphore(RESURECTION_CONCURRENCY)
+        self.profiler: SamplingProfiler | None = None
+        self.chat_admins: dict[int, tuple[float, frozenset[int]]] = {}  # chat_id -> (expiry, administrator user ids)
+        self.admin_fetches: dict[int, asyncio.Task] = {}
+        self.profile_task: asyncio.Task | None = None
         try:
             with open("email_credentials.json", "r") as infile:
                 self.email_credentials = json.load(infile)
         except (FileNotFoundError, ValueError):
             self.email_credentials = {}
         self.tz_conv = "https://hamletdufromage.github.io/unix-to-tz/?timestamp="
-
-        self.application = ApplicationBuilder().token(TOKEN).post_init(self.post_init).build()
+        self.catalogue = StoreCatalogue(CATALOGUE_FNAME)
+        self.availability = AvailabilityLog(AVAILABILITY_LOG)
+        self.drop_minutes: dict[tuple[str, ZoneInfo | None], tuple[float, int | None]] = {}  # (item_id, timezone) -> (expiry, usual drop minute of the day)
+        self.dashboards = DashboardSink(self)
+        sinks: list[Sink] = [TelegramSink(self), EmailSink(self), self.dashboards]
+        if EVENTS_FILE:
+            sinks.append(NdjsonSink(EVENTS_FILE))
+        self.events = EventBus(sinks)
+
+        self.application = ApplicationBuilder().token(TOKEN).post_init(self.post_init).post_stop(self.post_stop).post_shutdown(self.post_shutdown) \
+            .concurrent_updates(ChatUpdateProcessor(CONCURRENT_UPDATES)).build()
 
     async def post_init(self, application: Application) -> None:
+        self.events.start()
+        if hasattr(signal, "SIGUSR1") and profilingSupported():
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, self.profileOnSignal)
         await self.setCommands()
         await self.resume_bots()
 
+    async def post_stop(self, application: Application) -> None:
+        await self.events.stop()  # delivers what is still queued while the bot can still send messages
+
+    async def post_shutdown(self, application: Application) -> None:
+        self.availability.flush()
+        self.checkpoint()
+
+    def checkpoint(self) -> None:
+        # runtime state that isn't in the users' configs, restored by restoreCheckpoint on the next start
+        state = {"time": time.time(),
+                 "users": {chat_id: user.getState() for chat_id, user in self.users.items() if self.ownsUser(user)}}
+        with open(f"{CHECKPOINT_FNAME}.tmp", "w") as outfile:
+            json.dump(state, outfile)
+        os.replace(f"{CHECKPOINT_FNAME}.tmp", CHECKPOINT_FNAME)
+        logging.warning("Checkpointed the state of %s users", len(state["users"]))
+
+    def restoreCheckpoint(self) -> set[int]:
+        try:
+            with open(CHECKPOINT_FNAME, "r") as infile:
+                state = json.load(infile)
+            os.remove(CHECKPOINT_FNAME)  # don't restore the same state twice after a crash
+        except (FileNotFoundError, ValueError):
+            return set()
+        if time.time() - state.get("time", 0) > CHECKPOINT_MAX_AGE:
+            logging.warning("Ignoring a checkpoint older than %ss", CHECKPOINT_MAX_AGE)
+            return set()
+        restored = set()
+        for chat_id, user_state in state.get("users", {}).items():
+            user = self.users.get(int(chat_id))
+            if user:
+                user.setState(user_state)
+                restored.add(user.chat_id)
+        logging.warning("Restored the state of %s users from the checkpoint", len(restored))
+        return restored
+
     async def resume_bots(self, context: CallbackContext | None=None) -> None:
-        for chat_id in self.users.keys():
-            await self.create_watcher(self.users.get(chat_id), resurection=True) # type: ignore
+        for user in list(self.users.values()):
+            chat_id = user.chat_id
+            if user.watching and self.ownsUser(user) and chat_id not in self.live_watchers and chat_id not in self.reviving:
+                self.reviving.add(chat_id)
+                if chat_id in self.restored:
+                    # warm start, keep the checkpointed schedule
+                    self.restored.discard(chat_id)
+                    delay = min(max(user.next_poll - time.time(), 0), user.watch_interval)
+                else:
+                    delay = random.uniform(0, RESURECTION_JITTER)
+                asyncio.create_task(self.revive_watcher(user, delay))
+
+    async def revive_watcher(self, user: User, delay: float) -> None:
+        try:
+            await asyncio.sleep(delay)
+            async with self.resurection_slots:
+                await self.create_watcher(user, resurection=True)
+        finally:
+            self.reviving.discard(user.chat_id)
 
     def runBot(self) -> None:
         self.handleHandlers()
         if self.application.job_queue:
             self.application.job_queue.run_repeating(self.resume_bots, interval=RESURECTION_INTERVAL, first=RESURECTION_INTERVAL)
-        self.application.run_polling()
+        if self.leases:
+            if self.application.job_queue:
+                self.application.job_queue.run_repeating(self.renew_leases, interval=LEASE_RENEW_INTERVAL, first=LEASE_RENEW_INTERVAL)
+            asyncio.run(self.runClusterNode())
+        elif WEBHOOK_URL:
+            self.application.run_webhook(**self.webhookOptions())
+        else:
+            self.application.run_polling(allowed_updates=ALLOWED_UPDATES)
+
+    def webhookOptions(self) -> dict:
+        return {"listen": WEBHOOK_LISTEN, "port": WEBHOOK_PORT, "url_path": WEBHOOK_PATH,
+                "webhook_url": f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}", "secret_token": WEBHOOK_SECRET, # type: ignore
+                "cert": WEBHOOK_CERT, "key": WEBHOOK_KEY, "allowed_updates": ALLOWED_UPDATES}
+
+    async def runClusterNode(self) -> None:
+        # only the node holding the updates lease consumes Telegram updates, every node watches its own partitions
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        async with self.application:
+            await self.renew_leases()
+            await self.post_init(self.application)
+            await self.application.start()
+            await stop.wait()
+            if self.application.updater and self.application.updater.running:
+                await self.application.updater.stop()
+            await self.application.stop()
+            await self.post_stop(self.application)
+        await self.post_shutdown(self.application)
+        await asyncio.to_thread(self.leases.release) # type: ignore
+        logging.warning("Node %s released its leases", self.leases.node_id) # type: ignore
+
+    def ownsUser(self, user: User) -> bool:
+        return self.leases is None or self.leases.owns(user.chat_id)
+
+    async def startUpdater(self) -> None:
+        if WEBHOOK_URL:
+            await self.application.updater.start_webhook(**self.webhookOptions()) # type: ignore
+        else:
+            await self.application.updater.start_polling(allowed_updates=ALLOWED_UPDATES) # type: ignore
+
+    async def renew_leases(self, context: CallbackContext | None=None) -> None:
+        try:
+            acquired, lost = await asyncio.to_thread(self.leases.renew) # type: ignore
+        except Exception as e:
+            logging.error("Failed to renew leases for node %s: %s", self.leases.node_id, e) # type: ignore
+            return
+        if acquired or lost:
+            logging.info("Node %s acquired partitions %s, lost %s", self.leases.node_id, sorted(acquired), sorted(lost)) # type: ignore
+        for user in list(self.users.values()):
+            if not self.ownsUser(user) and hasattr(user, "watcher") and not user.watcher.done():
+                user.watcher.cancel()  # handed over, the new owner resurrects it
+        await self.syncUsers()
+        updater = self.application.updater
+        if updater:
+            if self.leases.hasUpdatesLease() and not updater.running: # type: ignore
+                await self.startUpdater()
+            elif not self.leases.hasUpdatesLease() and updater.running: # type: ignore
+                await updater.stop()
+
+    async def syncUsers(self) -> None:
+        for chat_id, user in self.getUsers(r"^config_(.+)\.json$", self.users).items():
+            if chat_id not in self.users:
+                self.users[chat_id] = user
+            elif user.isConfigStale():
+                user.reloadConfig()
+            if self.ownsUser(user) and not user.watching and hasattr(user, "watcher") and not user.watcher.done():
+                user.watcher.cancel()
+        await self.resume_bots()
 
     def handleHandlers(self) -> None:
         for func in self.commands.keys():
             self.application.add_handler(CommandHandler(func.__name__, func), group=0)
+        self.application.add_handler(ChatMemberHandler(self.chatMemberUpdated, ChatMemberHandler.ANY_CHAT_MEMBER), group=0)
+        self.application.add_handler(CommandHandler("profile", self.profile), group=0)  # admins only, not advertised
         self.application.add_handler(MessageHandler(filters.COMMAND, self.wrong_command), group=0)
         self.application.add_handler(MessageHandler(filters.COMMAND, self.command_logger), group=1)
 
@@ -219,23 +624,29 @@ class TooGoodToGoTelegram:
         user_id = getattr(update.effective_user, "id", 0)
         username = getattr(update.effective_user, "username", "error_username")
         name = getattr(update.effective_user, "first_name", "error_first_name")
-        logging.warning(f"User {name} logged in. chat_id: {chat_id} | user_id: {user_id} | username: {username}")
+        logging.warning("User %s logged in. chat_id: %s | user_id: %s | username: %s", name, chat_id, user_id, username, extra={"chat_id": chat_id})
 
     def getUser(self, update: Update) -> User:
         chat_id = getattr(update.effective_chat, "id", 0)
         if chat_id in self.users:
-            return self.users.get(chat_id) # type: ignore
+            user = self.users.get(chat_id)
+            if self.leases and user.isConfigStale(): # type: ignore
+                user.reloadConfig() # type: ignore
+            return user # type: ignore
         else:
             self.logNewUser(update)
-            return User(chat_id)
+            user = User(chat_id)
+            self.users[chat_id] = user
+            return user
 
-    def getUsers(self, config_pattern: str) -> dict[int, User]:
+    def getUsers(self, config_pattern: str, known: dict[int, User] | None = None) -> dict[int, User]:
+        known = known or {}
         users = {}
         for p in Path.cwd().glob(f"*"):
             match = re.search(config_pattern, p.name)
             if match:
                 chat_id = int(match.group(1))
-                users[chat_id] = User(chat_id)
+                users[chat_id] = known.get(chat_id) or User(chat_id)
         return users
 
     def errorText(self, error: Exception) -> str:
@@ -244,7 +655,7 @@ class TooGoodToGoTelegram:
     async def handleError(self, error: TgtgConnectionError, user: User, silence_first: bool=False) -> bool:
         silent = user.api.failed_requests <= 1 and silence_first
         try:
-            logging.error(f"Chat {user.chat_id} - {error}")
+            logging.error("Chat %s - %s", user.chat_id, error, extra={"chat_id": user.chat_id, "endpoint": error.endpoint})
             if not silent:
                 await self.application.bot.send_message(chat_id=user.chat_id, text=self.errorText(error), disable_notification=True, disable_web_page_preview=True)
             if type(error) == TgtgUnauthorizedError:
@@ -252,7 +663,7 @@ class TooGoodToGoTelegram:
                     await self.refresh_token(user, silent)
                 return True
             elif type(error) == TgtgBadRequestError:
-                logging.error(f"Bad request: {error.response.text}")
+                logging.error("Bad request: %s", error.response.text, extra={"chat_id": user.chat_id, "endpoint": error.endpoint})
                 return True
             elif type(error) == TgtgForbiddenError:
                 if error.captcha:
@@ -262,18 +673,20 @@ class TooGoodToGoTelegram:
                         await self.refresh_token(user)
                     return True
         except:
-            logging.error(f"Unexpected handleError error for {user.chat_id}: {error}")
+            logging.error("Unexpected handleError error for %s: %s", user.chat_id, error, extra={"chat_id": user.chat_id})
         return False
 
     def randMultiplier(self) -> float:
         return 1 + random.randint(-100, 100)/1000
 
     def getUnixPickupInterval(self, pickup_interval: dict[str, str]) -> tuple[int, int]:
+        from dateutil import parser
         start = int(datetime.datetime.timestamp(parser.parse(pickup_interval["start"])))
         end = int(datetime.datetime.timestamp(parser.parse(pickup_interval["end"])))
         return (start, end)
 
     def calculateRelativePickupInterval(self, pickup_interval: dict[str, str]) -> tuple[str, str]:
+        from dateutil import parser
         now = datetime.datetime.now(datetime.timezone.utc)
         zero_delta = datetime.timedelta(0)  # don't want no negative deltas
         start_delta = max(parser.parse(pickup_interval["start"]) - now, zero_delta)
@@ -304,13 +717,44 @@ class TooGoodToGoTelegram:
             await self.refresh_token(user)
             return True
         if user.api.requests_count % MODULO_REQUESTS_TO_LOG == 0:
-            logging.info(f"Chat {user.chat_id} has been sending {user.api.requests_count} consecutive successful requests")
+            logging.info("Chat %s has been sending %s consecutive successful requests", user.chat_id, user.api.requests_count, extra={"chat_id": user.chat_id})
         return False
 
     async def hasOwnerRights(self, update: Update) -> bool:
         chat_type = getattr(update.effective_chat, "type", "private")
         return chat_type == "private" or \
-            update.effective_user in [admin.user for admin in await update.effective_chat.get_administrators()] # type: ignore
+            getattr(update.effective_user, "id", None) in await self.chatAdmins(update.effective_chat) # type: ignore
+
+    async def chatAdmins(self, chat) -> frozenset[int]:
+        # cached per chat, concurrent checks of the same chat share a single getChatAdministrators call
+        expiry, admins = self.chat_admins.get(chat.id, (0.0, frozenset()))
+        if expiry > time.monotonic():
+            return admins
+        fetch = self.admin_fetches.get(chat.id)
+        if fetch is None:
+            fetch = asyncio.create_task(self.fetchChatAdmins(chat))
+            self.admin_fetches[chat.id] = fetch
+            fetch.add_done_callback(lambda task: self.adminFetchDone(chat.id, task))
+        return await asyncio.shield(fetch)
+
+    async def fetchChatAdmins(self, chat) -> frozenset[int]:
+        admins = frozenset(admin.user.id for admin in await chat.get_administrators())
+        if self.admin_fetches.get(chat.id) is asyncio.current_task():  # not invalidated while fetching
+            self.chat_admins[chat.id] = (time.monotonic() + ADMINS_CACHE_TTL, admins)
+        return admins
+
+    def adminFetchDone(self, chat_id: int, task: asyncio.Task) -> None:
+        if self.admin_fetches.get(chat_id) is task:
+            self.admin_fetches.pop(chat_id)
+
+    async def chatMemberUpdated(self, update: Update, context: CallbackContext) -> None:
+        member = update.chat_member or update.my_chat_member
+        if member is None:
+            return
+        statuses = (constants.ChatMemberStatus.ADMINISTRATOR, constants.ChatMemberStatus.OWNER)
+        if member.old_chat_member.status in statuses or member.new_chat_member.status in statuses:
+            self.chat_admins.pop(member.chat.id, None)
+            self.admin_fetches.pop(member.chat.id, None)
 
     def createHyperlink(self, link: str, text: str) -> str:
         return f"<a href=\"{link}\">{text}</a>"
@@ -325,51 +769,193 @@ class TooGoodToGoTelegram:
         while user.shouldWatch() and not await self.exceedQuota(user):
             start = datetime.datetime.now()
             try:
-                text = ""
-                matches = user.getMatches(user.targets)
-                for item_id, match in matches.items():
-                    available = match.get("available")
-                    purchase_end = match.get("purchase_end")
-                    description = self.tgtgShareUrl(item_id, match.get("display_name"))
-                    if user.seen.get(item_id, None) != purchase_end:
-                        text += f"👉🏻 {description} - {match.get('price')} (avail: {available})\n"
-                        user.seen[item_id] = purchase_end
-                if text:
-                    await self.sendPinnedMessage(chat_id=user.chat_id, text=text, parse_mode=constants.ParseMode.HTML, pinned=user.telegram_config.get("pinning"), email=user.telegram_config.get("email_notifications"))
+                if self.leases and user.isConfigStale():  # tokens refreshed or targets changed by another node
+                    user.reloadConfig()
+                targets = frozenset(user.targets)
+                observed: list[tuple[str, int]] = []
+                matches = await asyncio.to_thread(user.getMatches, user.targets, minQty=0, observer=lambda *entry: observed.append(entry))
+                for item_id, available in observed:  # the log isn't thread safe, record from the event loop
+                    self.availability.record(item_id, available)
+                detected = time.perf_counter()
+                user.setSnapshot(targets, matches)
+                events = diffItems(user.chat_id, user.seen, matches)
+                await self.autoReserve(user, events, detected)
+                self.events.publish(events)
+                user.prepareReservations()
+                hot = self.burstCandidate(user, matches, events)
+                if hot:
+                    await self.burstPoll(user, hot)  # the regular scan waits for the burst to end
             except TgtgConnectionError as error:
                 await self.handleError(error, user, True)
             except Exception as e:
-                logging.error(f"Unexpected error in watchLoop for {user.chat_id}: {e}")
-            sleep_time = max(user.watch_interval - (datetime.datetime.now() - start).total_seconds(), 0)
-            await asyncio.sleep(sleep_time * self.randMultiplier())
+                logging.error("Unexpected error in watchLoop for %s: %s", user.chat_id, e, extra={"chat_id": user.chat_id})
+            sleep_time = max(user.watch_interval - (datetime.datetime.now() - start).total_seconds(), 0) * self.randMultiplier()
+            user.next_poll = time.time() + sleep_time
+            await asyncio.sleep(sleep_time)
         await self.stop_watcher(user)
 
+    async def autoReserve(self, user: User, events: list[ItemEvent], detected: float) -> None:
+        for event in events:
+            target = user.targets.get(event.item_id)
+            if event.kind != APPEARED or not target or not target.get("auto_reserve") or target.get("qty", 1) < 1:
+                continue
+            if "reserved" in target and target["reserved"] == event.purchase_end:
+                continue  # our own unpaid reservation expired and the bag came back, don't reserve it again
+            item_count = min(target.get("qty", 1), event.available)
+            share_url = self.tgtgShareUrl(event.item_id, event.display_name)
+            try:
+                await asyncio.to_thread(user.api.createOrder, event.item_id, item_count)
+                latency = (time.perf_counter() - detected) * 1000
+                target["reserved"] = event.purchase_end  # once per drop, /auto_reserve rearms it
+                user.api.saveConfig()
+                logging.info("Reserved %s of item %s for chat %s in %.0fms", item_count, event.item_id, user.chat_id, latency,
+                             extra={"chat_id": user.chat_id, "endpoint": "order/create"})
+                text = f"🛒 Reserved {item_count} × {share_url} in {latency:.0f} ms. Pay for it in the app before the reservation expires!"
+            except TgtgOrderError as error:
+                logging.warning("Failed to reserve item %s for chat %s: %s", event.item_id, user.chat_id, error.reason,
+                                extra={"chat_id": user.chat_id, "endpoint": error.endpoint})
+                text = f"❌ Couldn't reserve {share_url}: {error.reason}"
+            except TgtgConnectionError as error:
+                await self.handleError(error, user)
+                continue
+            await self.application.bot.send_message(chat_id=user.chat_id, text=text, parse_mode=constants.ParseMode.HTML, disable_web_page_preview=True)
+
+    def usualDropMinute(self, item_id: str, tz: ZoneInfo | None) -> int | None:
+        now = time.time()
+        expiry, minute = self.drop_minutes.get((item_id, tz), (0.0, None))
+        if expiry < now:
+            stats = self.availability.restockStats(item_id, now - 14 * 86400, tz=tz)
+            minute = stats.get("median_drop_minute") if stats["restocks"] >= 2 else None
+            self.drop_minutes[(item_id, tz)] = (now + 3600, minute)
+        return minute
+
+    def burstCandidate(self, user: User, matches: dict[str, dict], events: list[ItemEvent]) -> str | None:
+        # a sold out target whose store just restocked another item, or that is due to drop according to its history
+        now = time.time()
+        restocked_stores = {matches[event.item_id].get("store_id") for event in events if event.kind == APPEARED}
+        restocked_stores.discard(None)
+        tz = user.getTimezone()
+        local = datetime.datetime.fromtimestamp(now, tz)
+        minute_now = local.hour * 60 + local.minute
+        for item_id, match in matches.items():
+            if match.get("available", 0) > 0 or user.burst_cooldowns.get(item_id, 0) > now:
+                continue
+            if match.get("store_id") in restocked_stores:
+                return item_id
+            pickup_interval = match.get("pickup_interval")
+            if not pickup_interval or self.getUnixPickupInterval(pickup_interval)[0] < now:
+                continue  # no upcoming pickup slot to sell
+            minute = self.usualDropMinute(item_id, tz)
+            if minute is not None and min(abs(minute_now - minute), 1440 - abs(minute_now - minute)) <= BURST_WINDOW:
+                return item_id
+        return None
+
+    async def burstPoll(self, user: User, item_id: str) -> None:
+        user.burst_cooldowns[item_id] = time.time() + BURST_COOLDOWN
+        user.burst_stats["bursts"] += 1
+        deadline = time.monotonic() + BURST_DURATION
+        logging.info("Burst polling item %s for chat %s", item_id, user.chat_id, extra={"chat_id": user.chat_id})
+        while time.monotonic() < deadline and user.shouldWatch() and user.spendBurstBudget():
+            start = time.monotonic()
+            try:
+                item = (await asyncio.to_thread(user.api.getItemInfo, item_id)).json()
+            except TgtgConnectionError as error:
+                await self.handleError(error, user, True)
+                return
+            user.burst_stats["requests"] += 1
+            available = item.get("items_available", 0)
+            self.availability.record(item_id, available)
+            if available > 0:
+                detected = time.perf_counter()
+                _, matches = user.rules.evaluate([item], 1)
+                if not matches:  # back, but outside the target's filters (sold out items have no pickup slot to filter on)
+                    return
+                user.burst_stats["caught"] += 1
+                _, _, rule = matches[0]
+                events = diffItems(user.chat_id, user.seen, {item_id: user.matchEntry(item, user.targets[rule.key])})
+                await self.autoReserve(user, events, detected)
+                self.events.publish(events)
+                return
+            await asyncio.sleep(max(BURST_INTERVAL - (time.monotonic() - start), 0))
+
+    def eventsText(self, events: list[ItemEvent]) -> str:
+        return "".join(f"👉🏻 {self.tgtgShareUrl(event.item_id, event.display_name)} - {event.price} (avail: {event.available})\n"
+                       for event in events)
+
+    def dashboardText(self, user: User, board: dict[str, ItemEvent]) -> str:
+        if not user.watching:
+            return "📋 Not watching, resume the dashboard with /watch."
+        events = [event for item_id, event in board.items() if item_id in user.targets or "*" in user.targets]
+        if not events:
+            return "📋 None of your targets is available right now."
+        events.sort(key=lambda event: event.display_name.lower())
+        return f"📋 Available right now:\n{self.eventsText(events)}"
+
+    async def updateDashboard(self, user: User, text: str) -> None:
+        # edits the dashboard, or posts and pins a new one when there is none or it was deleted
+        message_id = user.telegram_config.get("dashboard_message")
+        if message_id:
+            try:
+                await self.application.bot.edit_message_text(text, chat_id=user.chat_id, message_id=message_id,
+                                                             parse_mode=constants.ParseMode.HTML, disable_web_page_preview=True)
+                return
+            except error.BadRequest as e:
+                if "not modified" in e.message:
+                    return
+        message = await self.application.bot.send_message(chat_id=user.chat_id, text=text, parse_mode=constants.ParseMode.HTML,
+                                                          disable_web_page_preview=True)
+        await self.application.bot.pin_chat_message(chat_id=user.chat_id, message_id=message.message_id, disable_notification=True)
+        user.telegram_config["dashboard_message"] = message.message_id
+        user.api.saveConfig()
+
+    async def latestMatches(self, user: User) -> tuple[float, dict[str, dict]]:
+        # the watcher's last poll when it is recent enough, a new poll otherwise
+        snapshot = user.getSnapshot(SNAPSHOT_MAX_AGE)
+        if snapshot is None:
+            targets = frozenset(user.targets)
+            matches = await asyncio.to_thread(user.getMatches, user.targets, 0)
+            user.setSnapshot(targets, matches)
+            snapshot = (time.time(), matches)
+        return snapshot
+
+    def snapshotAge(self, taken: float) -> str:
+        return f"🕒 Data from {max(time.time() - taken, 0):.0f}s ago."
+
     async def dry_run(self, update: Update, context) -> None:
         await self.show_targets(update, context)
         user = self.getUser(update)
         try:
             text = ""
-            matches = user.getMatches(user.targets, minQty=0)
+            taken, matches = await self.latestMatches(user)
             matches = dict(sorted(matches.items(), key=lambda item: item[1].get("display_name", "").lower()))
             for item_id, match in matches.items():
                 available = match.get("available")
                 description = self.tgtgShareUrl(item_id, match.get("display_name"))
                 text += f"👉🏻 {description} - {match.get('price')} (avail: {available})\n"
             if text:
-                text = f"Found {len(matches)} matches:\n" + text
+                text = f"Found {len(matches)} matches:\n" + text + self.snapshotAge(taken)
                 await context.bot.send_message(chat_id=user.chat_id, text=text, parse_mode=constants.ParseMode.HTML, disable_web_page_preview=True)
             else:
-                await context.bot.send_message(chat_id=user.chat_id, text="No magic bag matches targets.")
+                await context.bot.send_message(chat_id=user.chat_id, text=f"No magic bag matches targets.\n{self.snapshotAge(taken)}")
         except TgtgConnectionError as error:
             await self.handleError(error, user)
 
     async def create_watcher(self, user: User, resurection: bool=False) -> None:
-        if user.watching:
+        if user.watching and self.ownsUser(user):
             if hasattr(user, "watcher") == False or user.watcher.done():
                 if resurection:
-                    logging.info(f"Resurecting watcher for {user.chat_id}")
-                    await self.refresh_token(user, silent=True)
+                    logging.info("Resurecting watcher for %s", user.chat_id, extra={"chat_id": user.chat_id})
+                    if not user.api.isSessionValid():
+                        await self.refresh_token(user, silent=True)
+                    if not user.watching or (hasattr(user, "watcher") and not user.watcher.done()):
+                        return  # stopped or restarted while refreshing
                 user.watcher = asyncio.create_task(self.watchLoop(user))
+                self.live_watchers.add(user.chat_id)
+                user.watcher.add_done_callback(lambda task: self.watcherDone(user, task))
+
+    def watcherDone(self, user: User, task: asyncio.Task) -> None:
+        if user.watcher is task:
+            self.live_watchers.discard(user.chat_id)
 
     async def watch(self, update: Update, context: CallbackContext) -> None:
         user = self.getUser(update)
@@ -384,11 +970,13 @@ class TooGoodToGoTelegram:
         await self.show_targets(update, context)
         user.clearHistory()
         user.toggleWatching(True)
+        self.dashboards.redraw(user)
         await self.create_watcher(user)
 
     async def stop_watcher(self, user: User) -> None:
         await self.application.bot.send_message(chat_id=user.chat_id, text="Stopped watching the favorites.")
         user.toggleWatching(False)
+        self.dashboards.redraw(user)
 
     async def stop_watching(self, update: Update, context: CallbackContext) -> None:
         user = self.getUser(update)
@@ -403,20 +991,59 @@ class TooGoodToGoTelegram:
                 user.targets.update({target: {"qty": quantity, "display_name": "* All favorites"}})
                 text = f"Targeting all favorites with quantity {quantity}."
             else:
-                item_id, display_name = self.set_favorite(user, target)
+                if not re.search(r"\d", target):
+                    target = await asyncio.to_thread(self.findStore, user, target)
+                item_id, display_name = await asyncio.to_thread(self.set_favorite, user, target)
                 user.targets.update({item_id: {"qty": quantity, "display_name": display_name}})
                 share_url = self.tgtgShareUrl(item_id, display_name)
                 text = f"Targeting item {share_url} with quantity {quantity}."
-            user.targets = dict(sorted(user.targets.items(), key=lambda item: item[1].get("display_name", "").lower()))
-            user.api.config["targets"] = user.targets
-            user.api.saveConfig()
+            self.saveTargets(user)
         except (IndexError, ValueError, AttributeError):
             text = "Usage:\n/add_target [share_url] [quantity]\nWatch all the favorites with /add_target * [quantity]"
+        except LookupError as error:  # store name that isn't unique or unknown in the catalogue
+            text = str(error.args[0])
         except TgtgConnectionError as error:
             await self.handleError(error, user)
             return
         await context.bot.send_message(chat_id=user.chat_id, text=text, parse_mode=constants.ParseMode.HTML, disable_web_page_preview=True)
 
+    def findStore(self, user: User, name: str) -> str:
+        origin = user.api.config.get("origin")
+        candidates = self.catalogue.search(name)
+        if len(candidates) != 1:
+            nearby = {store["item_id"] for _, store in self.catalogue.nearby(origin["latitude"], origin["longitude"], DISCOVERY_MAX_RADIUS)}
+            candidates = [store for store in candidates if store["item_id"] in nearby] or candidates
+        if len(candidates) == 1:
+            return candidates[0]["item_id"]
+        if not candidates:
+            raise LookupError(f"No known store matches \"{html.escape(name)}\". Run /discover first or use a share url.")
+        stores = "\n".join(f"• {self.tgtgShareUrl(store['item_id'], store['display_name'])} ({store['item_id']})" for store in candidates[:10])
+        raise LookupError(f"Several stores match \"{html.escape(name)}\", use one of their ids:\n{stores}")
+
+    async def add_targets(self, update: Update, context: CallbackContext) -> None:
+        user = self.getUser(update)
+        try:
+            quantity = int(context.args[-1]) # type: ignore
+            if len(context.args) < 2: # type: ignore
+                raise IndexError
+        except (IndexError, ValueError, TypeError):
+            text = "Usage:\n/add_targets [share_url] ([share_url]…) [quantity]"
+            await context.bot.send_message(chat_id=user.chat_id, text=text)
+            return
+        added, failed = await self.set_favorites(user, context.args[:-1]) # type: ignore
+        for item_id, display_name in added:
+            user.targets.update({item_id: {"qty": quantity, "display_name": display_name}})
+        if added:
+            self.saveTargets(user)
+        text = f"Targeting {len(added)} items with quantity {quantity}:\n" + self.bulkReport(added, failed)
+        await context.bot.send_message(chat_id=user.chat_id, text=text, parse_mode=constants.ParseMode.HTML, disable_web_page_preview=True)
+
+    def saveTargets(self, user: User) -> None:
+        user.targets = dict(sorted(user.targets.items(), key=lambda item: item[1].get("display_name", "").lower()))
+        user.api.config["targets"] = user.targets
+        user.compileRules()
+        user.api.saveConfig()
+
     async def remove_target(self, update: Update, context: CallbackContext) -> None:
         user = self.getUser(update)
         try:
@@ -430,17 +1057,66 @@ class TooGoodToGoTelegram:
                 descriptions.append(self.tgtgShareUrl(item_id, user.targets.get(item_id).get("display_name")))
                 user.targets.pop(item_id)
             text = "Removed the following from targets:\n" + "\n".join(f"• {desc}" for desc in descriptions)
-            user.api.saveConfig()
+            self.saveTargets(user)
         except (IndexError, ValueError, KeyError):
             text = "Usage:\n/remove_target [index] ([index])"
         await context.bot.send_message(chat_id=user.chat_id, text=text, parse_mode=constants.ParseMode.HTML, disable_web_page_preview=True)
 
     async def show_targets(self, update: Update, context: CallbackContext) -> None:
         user = self.getUser(update)
-        targets = [f"📌 [{index}] {self.tgtgShareUrl(key, value.get('display_name'))} (qty: {value.get('qty')})" for index, (key, value) in enumerate(user.targets.items())]
+        targets = [f"📌 [{index}] {self.tgtgShareUrl(key, value.get('display_name'))} (qty: {value.get('qty')}){' 🛒' if value.get('auto_reserve') else ''}"
+                   f"{' 🔎 ' + html.escape(describeFilters(value)) if describeFilters(value) else ''}" for index, (key, value) in enumerate(user.targets.items())]
         text = f"Targeting the following {len(targets)} items:\n" + "\n".join(targets)
         await context.bot.send_message(chat_id=user.chat_id, text=text, parse_mode=constants.ParseMode.HTML, disable_web_page_preview=True)
 
+    async def auto_reserve(self, update: Update, context: CallbackContext) -> None:
+        user = self.getUser(update)
+        try:
+            item_id = list(user.targets)[int(context.args[0])] # type: ignore
+            enabled = context.args[1] != "0" # type: ignore
+            if item_id == "*":
+                raise ValueError
+            user.targets[item_id]["auto_reserve"] = enabled
+            user.targets[item_id].pop("reserved", None)
+            user.api.saveConfig()
+            share_url = self.tgtgShareUrl(item_id, user.targets[item_id].get("display_name"))
+            if enabled:
+                text = f"🛒 Reserving {user.targets[item_id].get('qty')} × {share_url} as soon as it is available while watching."
+            else:
+                text = f"Not reserving {share_url} anymore."
+        except (IndexError, ValueError, TypeError):
+            text = "Usage:\n/auto_reserve [index] [0-1]\nSee the indexes with /show_targets."
+        await context.bot.send_message(chat_id=user.chat_id, text=text, parse_mode=constants.ParseMode.HTML, disable_web_page_preview=True)
+
+    async def set_filter(self, update: Update, context: CallbackContext) -> None:
+        user = self.getUser(update)
+        changed = False
+        try:
+            item_id = list(user.targets)[int(context.args[0])] # type: ignore
+            filters = parseFilters(" ".join(context.args[1:])) # type: ignore
+            target = user.targets[item_id]
+            for name in FILTERS:
+                target.pop(name, None)
+            target.update(filters)
+            self.saveTargets(user)
+            changed = True
+            share_url = self.tgtgShareUrl(item_id, target.get("display_name"))
+            if filters:
+                text = f"🔎 Only matching {share_url} for {html.escape(describeFilters(target))}."
+            else:
+                text = f"Removed the filters of {share_url}."
+        except (IndexError, ValueError, TypeError):
+            text = "Usage:\n/set_filter [index] (max_price=4.50) (pickup=18:00-20:00) (store=name)\nWithout filters, removes them. See the indexes with /show_targets."
+        await context.bot.send_message(chat_id=user.chat_id, text=text, parse_mode=constants.ParseMode.HTML, disable_web_page_preview=True)
+        if changed and user.watching and user.telegram_config.get("dashboard"):
+            # the items the new filters hide produce no sold out event, poll again to rebuild the dashboard
+            try:
+                await self.latestMatches(user)
+            except TgtgConnectionError as error:
+                await self.handleError(error, user)
+                return
+            self.dashboards.redraw(user)
+
     async def pin_results(self, update: Update, context: CallbackContext):
         user = self.getUser(update)
         try:
@@ -451,6 +1127,29 @@ class TooGoodToGoTelegram:
             text = "Usage:\n/pin_results [0-1]"
         await context.bot.send_message(chat_id=user.chat_id, text=text)
 
+    async def dashboard(self, update: Update, context: CallbackContext) -> None:
+        user = self.getUser(update)
+        try:
+            enabled = context.args[0] != "0" # type: ignore
+        except (IndexError, TypeError):
+            await context.bot.send_message(chat_id=user.chat_id, text="Usage:\n/dashboard [0-1]")
+            return
+        user.telegram_config["dashboard"] = enabled
+        message_id = user.telegram_config.pop("dashboard_message", None) if not enabled else None
+        user.api.saveConfig()
+        self.dashboards.forget(user.chat_id)
+        if enabled:
+            await self.dashboards.flush(user.chat_id)
+            text = "📋 Keeping a pinned dashboard of your available targets up to date. New magic bags still get their own alert."
+        else:
+            if message_id:
+                try:
+                    await context.bot.unpin_chat_message(chat_id=user.chat_id, message_id=message_id)
+                except error.TelegramError:
+                    pass
+            text = "Not updating the dashboard anymore."
+        await context.bot.send_message(chat_id=user.chat_id, text=text)
+
     async def notify_email(self, update: Update, context: CallbackContext) -> None:
         user = self.getUser(update)
         try:
@@ -470,7 +1169,18 @@ class TooGoodToGoTelegram:
 
     async def status(self, update: Update, context: CallbackContext) -> None:
         user = self.getUser(update)
-        await context.bot.send_message(chat_id=user.chat_id, text=f"👀 Watching status: [{user.watching}] with interval: {user.watch_interval}s.")
+        bursts = user.burst_stats
+        text = f"👀 Watching status: [{user.watching}] with interval: {user.watch_interval}s."
+        if bursts["bursts"]:
+            text += f"\n⚡ Burst polls: {bursts['bursts']}, caught a drop {bursts['caught']} times ({bursts['caught'] / bursts['bursts']:.0%}) for {bursts['requests']} requests."
+        if user.targets:
+            try:
+                taken, matches = await self.latestMatches(user)
+                available = sum(1 for match in matches.values() if match.get("available", 0) > 0)
+                text += f"\n🛍️ {available} of {len(matches)} matching bags available. {self.snapshotAge(taken)}"
+            except TgtgConnectionError as error:
+                await self.handleError(error, user)
+        await context.bot.send_message(chat_id=user.chat_id, text=text)
 
     def set_favorite(self, user, item_id):
         match = re.search(r"\D*(\d+)\D*", item_id)
@@ -484,7 +1194,7 @@ class TooGoodToGoTelegram:
     async def add_favorite(self, update: Update, context: CallbackContext) -> None:
         user = self.getUser(update)
         try:
-            item_id, display_name = self.set_favorite(user, context.args[0]) # type: ignore
+            item_id, display_name = await asyncio.to_thread(self.set_favorite, user, context.args[0]) # type: ignore
             share_url = self.tgtgShareUrl(item_id, display_name)
             text = f"⭐ Added {share_url} to the favorites!"
         except (AttributeError, IndexError):
@@ -494,13 +1204,142 @@ class TooGoodToGoTelegram:
             return
         await context.bot.send_message(chat_id=user.chat_id, text=text, parse_mode=constants.ParseMode.HTML, disable_web_page_preview=True)
 
+    async def add_favorites(self, update: Update, context: CallbackContext) -> None:
+        user = self.getUser(update)
+        if not context.args:
+            await context.bot.send_message(chat_id=user.chat_id, text="Usage:\n/add_favorites [store_url] ([store_url]…)")
+            return
+        added, failed = await self.set_favorites(user, context.args)
+        text = f"⭐ Added {len(added)} items to the favorites:\n" + self.bulkReport(added, failed)
+        await context.bot.send_message(chat_id=user.chat_id, text=text, parse_mode=constants.ParseMode.HTML, disable_web_page_preview=True)
+
+    async def set_favorites(self, user: User, targets: list[str]) -> tuple[list[tuple[str, str]], list[tuple[str, Exception]]]:
+        slots = asyncio.Semaphore(BULK_CONCURRENCY)
+        targets = list(dict.fromkeys(targets))
+
+        async def set_one(target: str) -> tuple[str, str]:
+            async with slots:
+                return await asyncio.to_thread(self.set_favorite, user, target)
+
+        results = await asyncio.gather(*(set_one(target) for target in targets), return_exceptions=True)
+        added, failed = [], []
+        for target, result in zip(targets, results):
+            if isinstance(result, Exception):
+                failed.append((target, result))
+            else:
+                added.append(result)
+        errors = [error for _, error in failed if isinstance(error, TgtgConnectionError)]
+        if errors:
+            await self.handleError(errors[0], user)  # once, e.g. to refresh the tokens
+        return added, failed # type: ignore
+
+    def bulkReport(self, added: list[tuple[str, str]], failed: list[tuple[str, Exception]]) -> str:
+        lines = [f"✅ {self.tgtgShareUrl(item_id, display_name)}" for item_id, display_name in added]
+        lines += [f"❌ {html.escape(target)}: {type(error).__name__}" for target, error in failed]
+        return "\n".join(lines)
+
+    async def orders(self, update: Update, context: CallbackContext) -> None:
+        user = self.getUser(update)
+        try:
+            count = int(context.args[0]) if context.args else 10
+            if count < 1:
+                raise ValueError
+            cache = user.getOrderCache()
+            await asyncio.to_thread(cache.sync, user.api)
+            lines = [f"🧾 [{index}] {order.get('time_of_purchase', '').split('T')[0]} {html.escape(str(order.get('store_name')))} - {order.get('state')} ({order.get('order_id')})"
+                     for index, order in enumerate(cache.latest(count))]
+            text = f"Your {len(lines)} most recent orders:\n" + "\n".join(lines) if lines else "No orders found."
+        except ValueError:
+            text = "Usage:\n/orders [count]"
+        except TgtgConnectionError as error:
+            await self.handleError(error, user)
+            return
+        await context.bot.send_message(chat_id=user.chat_id, text=text, parse_mode=constants.ParseMode.HTML)
+
+    async def resolveOrder(self, user: User, ref: str) -> tuple[str, dict | None]:
+        # accepts an order_id or an index from /orders, only fetches the orders we don't know yet
+        cache = user.getOrderCache()
+        if ref.isdigit() and int(ref) < 100:
+            latest = cache.latest(int(ref) + 1)
+            if len(latest) > int(ref):
+                order = latest[int(ref)]
+                return str(order.get("order_id")), order
+        order = cache.get(ref)
+        if order is None:
+            await asyncio.to_thread(cache.sync, user.api)
+            order = cache.get(ref)
+        return ref, order
+
+    async def discover(self, update: Update, context: CallbackContext) -> None:
+        user = self.getUser(update)
+        try:
+            radius = min(float(context.args[0]), DISCOVERY_MAX_RADIUS) if context.args else DISCOVERY_TILE_KM * 2
+        except ValueError:
+            await context.bot.send_message(chat_id=user.chat_id, text="Usage:\n/discover [radius_km]")
+            return
+        await context.bot.send_message(chat_id=user.chat_id, text=f"🗺️ Scanning the stores within {radius}km, this may take a while.")
+        try:
+            tiles, new, failed = await asyncio.to_thread(discover, user.api, self.catalogue, user.api.config.get("origin"), radius,
+                                                 DISCOVERY_TILE_KM, DISCOVERY_RATE, DISCOVERY_WORKERS)
+        except TgtgConnectionError as error:
+            await self.handleError(error, user)
+            return
+        text = f"Scanned {tiles - failed} areas, found {new} new stores. {len(self.catalogue.stores)} stores are known.\nList them with /nearby [radius_km] [name]."
+        if failed:
+            text += f"\n⚠️ {failed} areas could not be scanned, run /discover again later to complete them."
+        await context.bot.send_message(chat_id=user.chat_id, text=text)
+
+    async def nearby(self, update: Update, context: CallbackContext) -> None:
+        user = self.getUser(update)
+        try:
+            radius = min(float(context.args[0]), DISCOVERY_MAX_RADIUS) if context.args else DISCOVERY_TILE_KM
+            name = " ".join(context.args[1:]).lower() if context.args else ""
+        except ValueError:
+            await context.bot.send_message(chat_id=user.chat_id, text="Usage:\n/nearby [radius_km] [name]")
+            return
+        origin = user.api.config.get("origin")
+        stores = await asyncio.to_thread(self.catalogue.nearby, origin["latitude"], origin["longitude"], radius)
+        stores = [(distance, store) for distance, store in stores
+                  if name in store["display_name"].lower() or name in store["store_name"].lower()]
+        lines = [f"📍 {self.tgtgShareUrl(store['item_id'], store['display_name'])} - {distance:.1f}km ({store['item_id']})" for distance, store in stores[:30]]
+        if lines:
+            text = f"{len(stores)} known stores within {radius}km:\n" + "\n".join(lines) + "\nTarget one with /add_target [id] [quantity]."
+        else:
+            text = f"No known store within {radius}km. Scan your area with /discover."
+        await context.bot.send_message(chat_id=user.chat_id, text=text, parse_mode=constants.ParseMode.HTML, disable_web_page_preview=True)
+
+    async def restocks(self, update: Update, context: CallbackContext) -> None:
+        user = self.getUser(update)
+        try:
+            days = float(context.args[0]) if context.args else 30
+        except ValueError:
+            await context.bot.send_message(chat_id=user.chat_id, text="Usage:\n/restocks [days]")
+            return
+        start = datetime.datetime.now().timestamp() - days * 86400
+        tz = user.getTimezone()
+        lines = []
+        for item_id, target in user.targets.items():
+            if item_id == "*":
+                continue
+            stats = self.availability.restockStats(item_id, start, tz=tz)
+            line = f"📈 {self.tgtgShareUrl(item_id, target.get('display_name'))}: {stats['restocks']} restocks"
+            if "median_drop_minute" in stats:
+                minute = stats["median_drop_minute"]
+                line += f", usually around {minute // 60:02d}:{minute % 60:02d} (mostly {stats['busiest_hour']}h), {stats['median_quantity']:g} bags"
+            if "median_sellout_seconds" in stats:
+                line += f", sold out after ~{round(stats['median_sellout_seconds'] / 60)} min"
+            lines.append(line)
+        text = f"Restocks over the last {days:g} days ({tz or 'server time'}):\n" + "\n".join(lines) if lines else "No specific targets, add some with /add_target."
+        await context.bot.send_message(chat_id=user.chat_id, text=text, parse_mode=constants.ParseMode.HTML, disable_web_page_preview=True)
+
     async def invite(self, update: Update, context: CallbackContext) -> None:
         user = self.getUser(update)
         try: 
-            order_id = context.args[0] # type: ignore
+            order_id, order = await self.resolveOrder(user, context.args[0]) # type: ignore
             invitation = user.api.createInvitation(order_id)
             external_id = invitation.json().get("external_id")
-            text = f"✉️ Send this invation link to a friend for them to pickup your order:\n\nhttps://share.toogoodtogo.com/invitation/order/{external_id}"
+            store = f" at {html.escape(str(order.get('store_name')))}" if order else ""
+            text = f"✉️ Send this invation link to a friend for them to pickup your order{store}:\n\nhttps://share.toogoodtogo.com/invitation/order/{external_id}"
         except (AttributeError, IndexError):
             text = f"Usage:\n/invite [order_id]"
         except TgtgConnectionError as error:
@@ -511,7 +1350,7 @@ class TooGoodToGoTelegram:
     async def cancel_invite(self, update: Update, context: CallbackContext) -> None:
         user = self.getUser(update)
         try:
-            order_id = context.args[0] # type: ignore
+            order_id, _ = await self.resolveOrder(user, context.args[0]) # type: ignore
             invitation_id = user.api.createInvitation(order_id, False).json().get("id")
             canceled = user.api.cancelInvitation(invitation_id).json().get("state")
             text = f"Invitation status for order {order_id}: {canceled}"
@@ -583,15 +1422,15 @@ class TooGoodToGoTelegram:
 
     async def refresh_token(self, user: User, silent: bool=False) -> None:
         try:
-            user.api.updateAppVersion()
-            user.api.login()
+            await asyncio.to_thread(user.api.updateAppVersion)
+            await asyncio.to_thread(user.api.login)
             if not silent:
                 await self.application.bot.send_message(chat_id=user.chat_id, text=f"🔄 Refreshed the tokens.", disable_notification=True)
-            user.api.setUserDevice()
+            await asyncio.to_thread(user.api.setUserDevice)
         except TgtgConnectionError as error:
             await self.handleError(error, user)
         except Exception as error:
-            logging.error(f"Unexpected refresh_token error for {user.chat_id}: {error}")
+            logging.error("Unexpected refresh_token error for %s: %s", user.chat_id, error, extra={"chat_id": user.chat_id})
 
     async def refresh(self, update: Update, context: CallbackContext) -> None:
         user = self.getUser(update)
@@ -612,6 +1451,18 @@ class TooGoodToGoTelegram:
         except (IndexError, ValueError):
             await context.bot.send_message(chat_id=user.chat_id, text="Usage:\n/set_location [latitude] [longitude]")
 
+    async def set_timezone(self, update: Update, context: CallbackContext) -> None:
+        user = self.getUser(update)
+        try:
+            name = context.args[0] # type: ignore
+            ZoneInfo(name)
+            user.telegram_config["timezone"] = name
+            user.compileRules()
+            user.api.saveConfig()
+            await context.bot.send_message(chat_id=user.chat_id, text=f"Set your timezone to {name}", disable_notification=True)
+        except (IndexError, TypeError, ValueError, ZoneInfoNotFoundError):
+            await context.bot.send_message(chat_id=user.chat_id, text="Usage:\n/set_timezone [Europe/Paris]")
+
     async def set_datadome(self, update: Update, context: CallbackContext) -> None:
         user = self.getUser(update)
         #user.api.setCookie("")
@@ -633,6 +1484,53 @@ class TooGoodToGoTelegram:
             text = "No instance of the TooGoodNotToBot is running."
         await context.bot.send_message(chat_id=chat_id, text=text)
 
+    async def runProfiler(self, duration: float) -> str | None:
+        # one profile at a time, returns the folded stacks file
+        if self.profiler is not None:
+            return None
+        self.profiler = SamplingProfiler(asyncio.get_running_loop())
+        try:
+            logging.warning("Profiling for %ss", duration)
+            self.profiler.start()
+            try:
+                await asyncio.sleep(duration)
+            finally:
+                self.profiler.stop()
+            fname = f"profile_{int(time.time())}.folded"
+            await asyncio.to_thread(self.profiler.write, fname)
+            logging.warning("Wrote %s samples of %s stacks to %s", self.profiler.samples, len(self.profiler.stacks), fname)
+            return fname
+        finally:
+            self.profiler = None
+
+    def profileOnSignal(self) -> None:
+        if self.profile_task is None or self.profile_task.done():
+            self.profile_task = asyncio.create_task(self.runProfiler(PROFILE_DURATION))
+
+    async def profile(self, update: Update, context: CallbackContext) -> None:
+        chat_id = getattr(update.effective_chat, "id", 0)
+        if getattr(update.effective_user, "id", None) not in ADMIN_IDS:
+            await context.bot.send_message(chat_id=chat_id, text="⛔ Only the bot's admins can profile it.")
+            return
+        if not profilingSupported():
+            await context.bot.send_message(chat_id=chat_id, text="Profiling isn't supported on this platform.")
+            return
+        try:
+            duration = min(float(context.args[0]), PROFILE_MAX_DURATION) if context.args else PROFILE_DURATION
+            if duration <= 0:
+                raise ValueError
+        except ValueError:
+            await context.bot.send_message(chat_id=chat_id, text=f"Usage:\n/profile [seconds, up to {PROFILE_MAX_DURATION:.0f}]")
+            return
+        await context.bot.send_message(chat_id=chat_id, text=f"⏱️ Profiling every thread for {duration:.0f}s…")
+        fname = await self.runProfiler(duration)
+        if fname is None:
+            await context.bot.send_message(chat_id=chat_id, text="A profile is already running.")
+            return
+        with open(fname, "rb") as infile:
+            await context.bot.send_document(chat_id=chat_id, document=infile, filename=fname,
+                                            caption="Folded stacks, open them with speedscope or flamegraph.pl")
+
     async def clear_history(self, update: Update, context: CallbackContext) -> None:
         user = self.getUser(update)
         user.clearHistory()
@@ -664,14 +1562,18 @@ class TooGoodToGoTelegram:
         await context.bot.send_message(chat_id=update.effective_chat.id, text=text) # type: ignore
 
     async def command_logger(self, update: Update, context: CallbackContext) -> None:
-        logging.info(
-            f"`{update.message.text}` --- chat:{update.effective_chat.id} | {update.effective_user.first_name}: {update.effective_user.id}") # type: ignore
+        logging.info("`%s` --- chat:%s | %s: %s", update.message.text, update.effective_chat.id, update.effective_user.first_name, update.effective_user.id, # type: ignore
+                     extra={"chat_id": update.effective_chat.id}) # type: ignore
 
     async def setCommands(self) -> None:
         hints = [("/" + k.__name__, v) for k, v in self.commands.items()]
         await self.application.bot.set_my_commands(hints)
 
     async def send_email(self, recipient: str, content:str) -> None:
+        import aiosmtplib
+        from email.mime.text import MIMEText
+        from email.mime.multipart import MIMEMultipart
+
         message = MIMEMultipart()
         message['From'] = self.email_credentials.get("sender") # type: ignore
         message['To'] = recipient
@@ -691,7 +1593,7 @@ class TooGoodToGoTelegram:
         except TimeoutError:
             logging.error("Timed out when trying to send an email notification.")
         except Exception as e:
-            logging.error(f"Failed to send email: {e}")
+            logging.error("Failed to send email: %s", e)
 
 if __name__ == '__main__':
 
@@ -0,0 +1,120 @@
+import array
+import bisect
+import datetime
+import mmap
+import os
+import statistics
+import time
+from collections import Counter
+
+# one file per column, 14 bytes per observation
+COLUMNS = {"ts": "I", "item": "Q", "available": "H"}
+FLUSH_ROWS = 512
+FLUSH_INTERVAL = 60.0
+
+
+class AvailabilityLog:
+    # append-only (timestamp, item_id, available) log, flushed to disk in batches and read back through mmap
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.maps: dict[str, mmap.mmap] = {}
+        self.views: dict[str, memoryview] = {}
+        self.pending = {name: array.array(code) for name, code in COLUMNS.items()}
+        self.index: dict[int, array.array] = {}  # item_id -> row numbers, in time order
+        self.disk_rows = 0
+        self.flushed = time.monotonic()
+        self.load()
+
+    def fname(self, column: str) -> str:
+        return f"{self.prefix}.{column}"
+
+    def load(self) -> None:
+        sizes = {}
+        for name, code in COLUMNS.items():
+            if not os.path.exists(self.fname(name)):
+                open(self.fname(name), "wb").close()
+            sizes[name] = os.path.getsize(self.fname(name)) // array.array(code).itemsize
+        rows = min(sizes.values())
+        for name, code in COLUMNS.items():
+            if sizes[name] != rows:  # interrupted while flushing, drop the partial rows
+                os.truncate(self.fname(name), rows * array.array(code).itemsize)
+        self.remap(rows)
+        for row, item_id in enumerate(self.views.get("item", ())):
+            self.index.setdefault(item_id, array.array("I")).append(row)
+
+    def remap(self, rows: int) -> None:
+        for view in self.views.values():
+            view.release()
+        for m in self.maps.values():
+            m.close()
+        self.maps, self.views = {}, {}
+        self.disk_rows = rows
+        if rows == 0:
+            return
+        for name, code in COLUMNS.items():
+            with open(self.fname(name), "rb") as infile:
+                self.maps[name] = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+            self.views[name] = memoryview(self.maps[name]).cast(code)
+
+    def __len__(self) -> int:
+        return self.disk_rows + len(self.pending["ts"])
+
+    def value(self, column: str, row: int) -> int:
+        if row < self.disk_rows:
+            return self.views[column][row]
+        return self.pending[column][row - self.disk_rows]
+
+    def record(self, item_id: str | int, available: int, ts: float | None = None) -> None:
+        row = len(self)
+        self.pending["ts"].append(int(ts if ts is not None else time.time()))
+        self.pending["item"].append(int(item_id))
+        self.pending["available"].append(min(max(int(available), 0), 0xFFFF))
+        self.index.setdefault(int(item_id), array.array("I")).append(row)
+        if len(self.pending["ts"]) >= FLUSH_ROWS or time.monotonic() - self.flushed > FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self) -> None:
+        self.flushed = time.monotonic()
+        if not self.pending["ts"]:
+            return
+        rows = len(self)
+        for name, code in COLUMNS.items():
+            with open(self.fname(name), "ab") as outfile:
+                self.pending[name].tofile(outfile)
+            self.pending[name] = array.array(code)
+        self.remap(rows)
+
+    def series(self, item_id: str | int, start: float = 0, end: float = float("inf")) -> list[tuple[int, int]]:
+        rows = self.index.get(int(item_id), array.array("I"))
+        lo = bisect.bisect_left(rows, start, key=lambda row: self.value("ts", row))
+        hi = bisect.bisect_left(rows, end, key=lambda row: self.value("ts", row))
+        return [(self.value("ts", row), self.value("available", row)) for row in rows[lo:hi]]
+
+    def restockStats(self, item_id: str | int, start: float = 0, end: float = float("inf"), tz: datetime.tzinfo | None = None) -> dict:
+        # drop times are given in tz, the server's local time by default
+        drops, sellouts, quantities = [], [], []
+        restocked_at = None
+        previous = None
+        for ts, available in self.series(item_id, start, end):
+            if available > 0 and previous == 0:
+                restocked_at = ts
+                drops.append(ts)
+                quantities.append(available)
+            elif available == 0 and previous and restocked_at is not None:
+                sellouts.append(ts - restocked_at)
+                restocked_at = None
+            previous = available
+        res: dict = {"observations": len(self.index.get(int(item_id), ())), "restocks": len(drops)}
+        if drops:
+            moments = [datetime.datetime.fromtimestamp(ts, tz) for ts in drops]
+            minutes = [moment.hour * 60 + moment.minute for moment in moments]
+            res["median_drop_minute"] = int(statistics.median(minutes))
+            res["busiest_hour"] = Counter(minute // 60 for minute in minutes).most_common(1)[0][0]
+            res["median_quantity"] = statistics.median(quantities)
+        if sellouts:
+            res["median_sellout_seconds"] = int(statistics.median(sellouts))
+        return res
+
+    def close(self) -> None:
+        self.flush()
+        self.remap(0)
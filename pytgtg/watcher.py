@@ -1,8 +1,11 @@
+import json
+import logging
+import sys
 import threading
 import time
 import api
 import argparse
-from pprint import pprint
+from concurrent.futures import ThreadPoolExecutor
 
 from exceptions import (
     TgtgConnectionError,
@@ -10,64 +13,141 @@ from exceptions import (
     TgtgLoggedOutError,
     TgtgUnauthorizedError,
 )
+from orders import OrderCache
+from proxies import ProxyPool
+from ratelimit import RateLimiter
+
+PAGE_SIZE = 50
+
+output_lock = threading.Lock()
+logger = logging.getLogger("watcher")
+
+
+def emit(record: dict) -> None:
+    line = json.dumps(record, ensure_ascii=False)
+    with output_lock:
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
 
 
 class TooGoodToGoWatcher:
-    def __init__(self, config_fname="config.json"):
-        self.api = api.TooGoodToGoApi(config_fname)
+    def __init__(self, config_fname="config.json", limiter: RateLimiter | None = None, proxy_pool: ProxyPool | None = None):
+        self.config_fname = config_fname
+        self.api = api.TooGoodToGoApi(config_fname, proxy_pool)
+        self.limiter = limiter
+        self.orders = OrderCache(f"{config_fname.removesuffix('.json')}.orders.json")
 
     def consoleLogin(self):
         try:
             self.api.login()
             return True
         except TgtgLoggedOutError:
-            print("You are not logged in")
+            print(f"{self.config_fname}: You are not logged in", file=sys.stderr)
 
         try:
             auth_email_response = self.api.authByEmail()
             polling_id = auth_email_response.json().get("polling_id")
         except TgtgConnectionError as error:
-            print(repr(error))
+            print(repr(error), file=sys.stderr)
             return False
 
-        input(
-            f"The login email should have been sent to {self.api.getCredentials().get('email')}. Open the email on your PC and click the link. Don't open the email on a phone that has the TooGoodToGo app installed. That won't work. Press the Enter key when you clicked the link."
+        print(
+            f"The login email should have been sent to {self.api.getCredentials().get('email')}. Open the email on your PC and click the link. Don't open the email on a phone that has the TooGoodToGo app installed. That won't work. Press the Enter key when you clicked the link.",
+            file=sys.stderr,
         )
+        input()
         try:
             self.api.authPoll(polling_id)
-            print("✔️ Successfully logged in!")
+            print("✔️ Successfully logged in!", file=sys.stderr)
             self.api.setUserDevice()
             return True
         except TgtgConnectionError:
-            print("❌ Failed to login.")
+            print("❌ Failed to login.", file=sys.stderr)
             return False
 
+    def favorites(self):
+        page = 0
+        while True:
+            if self.limiter:
+                self.limiter.acquire()
+            items = self.api.listFavoriteBusinesses(page=page, page_size=PAGE_SIZE).json().get("favourite_items", [])
+            yield from items
+            if len(items) < PAGE_SIZE:
+                return
+            page += 1
+
+    def pollMatches(self):
+        matches = []
+        for item in self.favorites():
+            if item.get("items_available", 0) > 0:
+                matches.append({
+                    "time": time.time(),
+                    "config": self.config_fname,
+                    "item_id": str(item.get("item").get("item_id")),
+                    "display_name": item.get("display_name"),
+                    "available": item.get("items_available"),
+                    "purchase_end": item.get("purchase_end"),
+                })
+        return matches
+
     def listMatches(self):
         try:
-            businesses = self.api.listFavoriteBusinesses().json()
-            for item in businesses.get("favourite_items"):
-                if item.get("items_available", 0) > 0:
-                    print(
-                        f"{item.get('display_name')} (available: {item.get('items_available')})"
-                    )
+            for match in self.pollMatches():
+                print(f"{match.get('display_name')} (available: {match.get('available')})")
         except TgtgConnectionError as error:
             print(repr(error))
 
+    def streamMatches(self):
+        try:
+            for match in self.pollMatches():
+                emit(match)
+        except TgtgConnectionError as error:
+            print(f"{self.config_fname}: {error!r}", file=sys.stderr)
+            if isinstance(error, (TgtgUnauthorizedError, TgtgForbiddenError)):
+                try:
+                    self.api.login()
+                except (TgtgConnectionError, TgtgLoggedOutError) as error:
+                    print(f"{self.config_fname}: {error!r}", file=sys.stderr)
+        except Exception:  # a bad response from one account mustn't stop the others
+            logger.exception("%s: failed to poll the favourites", self.config_fname)
+
     def listOrders(self):
-        orders = self.api.getOrders()
-        orders = orders.json()
-        for month in orders.get("orders_per_month"):
-            for order in month.get("orders"):
-                print(
-                    order.get("time_of_purchase").split("T")[0],
-                    order.get("order_id"),
-                    order.get("state"),
-                    order.get("store_name"),
-                )
-                
+        self.orders.sync(self.api)
+        for order in self.orders.latest():
+            print(
+                order.get("time_of_purchase", "").split("T")[0],
+                order.get("order_id"),
+                order.get("state"),
+                order.get("store_name"),
+            )
+
+
+def watchAll(watchers: list[TooGoodToGoWatcher], sleep: float, count: int, duration: float, workers: int) -> None:
+    deadline = time.monotonic() + duration if duration > 0 else None
+    c = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            start = time.monotonic()
+            list(executor.map(TooGoodToGoWatcher.streamMatches, watchers))
+            c += 1
+            print(f"Watched favourites {c} times", file=sys.stderr)
+            if count > 0 and c >= count:
+                break
+            sleep_time = max(sleep - (time.monotonic() - start), 0)
+            if deadline is not None and time.monotonic() + sleep_time >= deadline:
+                break
+            time.sleep(sleep_time)
+    print("stopped watching", file=sys.stderr)
+
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="TooGoodToGo Watcher")
+    parser = argparse.ArgumentParser(description="TooGoodToGo Watcher, streams available favourites as NDJSON on stdout")
+    parser.add_argument(
+        "configs",
+        nargs="*",
+        default=["config.json"],
+        help="Config files of the accounts to watch (default: config.json)",
+    )
     parser.add_argument(
         "--sleep",
         type=int,
@@ -78,23 +158,41 @@ if __name__ == "__main__":
         "--count",
         type=int,
         default=200,
-        help="Number of iterations for checking (default: 200)",
+        help="Number of iterations for checking, 0 for no limit (default: 200)",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=0,
+        help="Stop watching after this many seconds, 0 for no limit (default: 0)",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=2.0,
+        help="Maximum number of requests per second across all accounts, 0 for no limit (default: 2)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=16,
+        help="Maximum number of accounts polled at the same time (default: 16)",
+    )
+    parser.add_argument(
+        "--proxy-file",
+        help="File with one HTTP or SOCKS proxy url per line, accounts are spread over the healthy ones",
     )
     args = parser.parse_args()
-    watcher = TooGoodToGoWatcher()
-    watcher.consoleLogin()
 
-    watcher.api.updateAppVersion()
-    print("user agent:", watcher.api.config["api"]["headers"]["user-agent"])
-    watcher.listOrders()
+    limiter = RateLimiter(args.rate, burst=max(int(args.rate), 1))
+    proxy_pool = ProxyPool(ProxyPool.readFile(args.proxy_file)) if args.proxy_file else None
+    watchers = [TooGoodToGoWatcher(config_fname, limiter, proxy_pool) for config_fname in args.configs]
+    watchers = [watcher for watcher in watchers if watcher.consoleLogin()]
+    if not watchers:
+        print("No account is logged in", file=sys.stderr)
+        sys.exit(1)
+    for watcher in watchers:
+        watcher.api.updateAppVersion()
+        print(f"{watcher.config_fname}: user agent: {watcher.api.getUserAgent()}", file=sys.stderr)
 
-    pprint(watcher.api.getItemInfo(1170509).json().get("display_name"))
-    c = 0
-    while True:
-        print(f"Watched favourites {c} times")
-        threading.Thread(target=watcher.listMatches())
-        if c > 200 == 0:
-            print("stopped watching")
-            break
-        time.sleep(args.sleep)
-        c += 1
+    watchAll(watchers, args.sleep, args.count, args.duration, min(args.workers, len(watchers)))